@@ -0,0 +1,323 @@
+# encoding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import os
+import sys
+import time
+import timeit
+import bisect
+import random
+import tempfile
+import contextlib
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sitegen import reader
+from sitegen.site import Site
+from sitegen.paging import Page, PageList
+from sitegen.stamper.stamper import Stamper
+from sitegen.stamper.parser import Parser
+from sitegen.stamper import tree
+from sitegen.stamper.lexer import Lexer
+
+LISTING_TEMPLATE = '''<ul>
+{% list pages as p: %}
+	<li class="{% if p.loop.first: %}first{% else: %}item{% end %}">
+		<a href="{{p.url}}">{{p.title}}</a> {{p.date | "%Y-%m-%d"}}
+		{% if p.loop.index % 2 == 0: %}even{% end %} {{p.loop.index + 1}}
+	</li>
+{% end %}
+</ul>'''
+
+
+def listing_context(size):
+	pages = []
+	for index in range(size):
+		pages.append({
+			'url': '/page{}/'.format(index),
+			'title': 'Page {}'.format(index),
+			'date': datetime(2020, 1, 1)
+		})
+	return {'pages': pages}
+
+
+def best_time(function, number):
+	return min(timeit.repeat(function, number=number, repeat=5)) / number
+
+
+def bench_stamper():
+	'''Render a page listing with the tree interpreter and compiled'''
+	context = listing_context(1000)
+	interpreted = Stamper(LISTING_TEMPLATE)
+	compiled = Stamper(LISTING_TEMPLATE, compiled=True)
+	assert interpreted.render(context) == compiled.render(context)
+	slow = best_time(lambda: interpreted.render(context), 10)
+	fast = best_time(lambda: compiled.render(context), 10)
+	print('Listing of 1000 pages')
+	print('  interpreted: {:.2f}ms'.format(slow * 1000))
+	print('  compiled:    {:.2f}ms ({:.1f}x)'.format(fast * 1000, slow / fast))
+
+
+OPTIMIZER_TEMPLATE = '''{% debug = false %}{% columns = 12 / 4 %}
+{% list pages as p: %}
+	<div class="col-{{ 12 / 4 }}" data-ttl="{{ 60 * 60 * 24 }}">
+		{% if debug: %}{{p.url}}{% end %}{% if false: %}<pre>{{p}}</pre>{% end %}
+		{% if true: %}<a href="{{p.url}}">{{p.title}}</a>{% else: %}-{% end %}
+		{% if 1 > 2 or false: %}never{% end %}{{ "<" + "/div>" }}
+{% end %}'''
+
+
+def visited_nodes(root, context):
+	'''Return the number of nodes rendered by the tree'''
+	count = 0
+	def profile(frame, event, _):
+		nonlocal count
+		if (event == 'call' and frame.f_code.co_name == 'render'
+				and isinstance(frame.f_locals.get('self'), tree.Node)):
+			count += 1
+	sys.setprofile(profile)
+	try:
+		root.render(context)
+	finally:
+		sys.setprofile(None)
+	return count
+
+
+def bench_optimizer():
+	'''Render a listing with and without optimizing its tree'''
+	context = listing_context(1000)
+	plain = Parser(OPTIMIZER_TEMPLATE, optimize=False).parse()
+	optimized = Parser(OPTIMIZER_TEMPLATE).parse()
+	assert plain.render(dict(context)) == optimized.render(dict(context))
+	slow = best_time(lambda: plain.render(dict(context)), 10)
+	fast = best_time(lambda: optimized.render(dict(context)), 10)
+	print('Listing of 1000 pages, {} nodes removed'.format(
+		optimized.removed_nodes))
+	print('  plain:     {} nodes visited, {:.2f}ms'.format(
+		visited_nodes(plain, dict(context)), slow * 1000))
+	print('  optimized: {} nodes visited, {:.2f}ms ({:.1f}x)'.format(
+		visited_nodes(optimized, dict(context)), fast * 1000, slow / fast))
+
+
+def bench_lexer():
+	'''Tokenize and parse a large template'''
+	text = '\n'.join([LISTING_TEMPLATE, OPTIMIZER_TEMPLATE] * 500)
+	tokens = len(Lexer().tokenize(text))
+	lexing = best_time(lambda: Lexer().tokenize(text), 3)
+	parsing = best_time(lambda: Parser(text).parse(), 3)
+	print('Template of {}KB, {} tokens'.format(len(text) // 1024, tokens))
+	print('  tokenize: {:.2f}ms'.format(lexing * 1000))
+	print('  parse:    {:.2f}ms'.format(parsing * 1000))
+
+
+LOOP_TEMPLATE = '''{% list pages as p: %}
+	{% list tags as t: %}{{t}} {% if t == p.category: %}{% break %}{% end %}{% end %}
+	{% n = 0 %}{% while true: %}{% n = n + 1 %}{% if n > 2: %}{% break %}{% end %}{% end %}
+{% end %}'''
+
+FUNCTION_TEMPLATE = '''{% function link(p): %}
+	{% if p.url: %}{% return "<a href='" + p.url + "'>" + p.title + "</a>" %}{% end %}
+	{% return p.title %}
+{% end %}
+{% list pages as p: %}{{link(p)}}{% end %}'''
+
+
+def bench_control():
+	'''Render loops ended by break and function calls ended by return,
+	with the tree interpreter and compiled'''
+	context = listing_context(1000)
+	context['tags'] = ['tag{}'.format(index) for index in range(5)]
+	for index, page in enumerate(context['pages']):
+		page['category'] = context['tags'][index % 5]
+	for name, text in (('break', LOOP_TEMPLATE),
+					   ('return', FUNCTION_TEMPLATE)):
+		interpreted = Stamper(text)
+		compiled = Stamper(text, compiled=True)
+		output = interpreted.render(dict(context))
+		assert output == compiled.render(dict(context))
+		if name == 'break':
+			# tags are listed backwards, only tag0 pages reach the last one
+			assert output.count('tag0') == 200
+		slow = best_time(lambda: interpreted.render(dict(context)), 10)
+		fast = best_time(lambda: compiled.render(dict(context)), 10)
+		print('{} in a listing of 1000 pages'.format(name.capitalize()))
+		print('  interpreted: {:.2f}ms'.format(slow * 1000))
+		print('  compiled:    {:.2f}ms ({:.1f}x)'.format(fast * 1000,
+													   slow / fast))
+
+
+SCOPE_TEMPLATE = '''{% list pages as p: %}
+	{% function label(item): %}{% return item.title + " " + site.name %}{% end %}
+	{% list tags as t: %}{{label(p)}} {{t}}{% end %}
+{% end %}'''
+
+
+def bench_scope():
+	'''Render nested loops and functions over a context of many names'''
+	context = listing_context(200)
+	context.update(('name{}'.format(index), index) for index in range(2000))
+	context['site'] = {'name': 'Site'}
+	context['tags'] = ['a', 'b', 'c']
+	stamper = Stamper(SCOPE_TEMPLATE)
+	timing = best_time(lambda: stamper.render(context), 10)
+	tracemalloc.start()
+	stamper.render(context)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	print('Listing of 200 pages in a context of 2000 names')
+	print('  {:.2f}ms, {}KB at most'.format(timing * 1000, peak // 1024))
+
+
+CONFIG_FILE = '''title = My site
+base_url = http://example.com/
+default_template = default
+feed_num = 10
+blocked_dirs = [drafts, tmp, old]
+categories = {
+	news = {
+		title = News
+		description = Site news
+	}
+	blog = {
+		title = Blog
+		description = Notes\\, posts and links
+	}
+	docs = {
+		title = Documentation
+	}
+}
+'''
+
+
+def page_file(index):
+	random.seed(index)
+	words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', '{{page.title}}']
+	body = '\n\n'.join(' '.join(random.choice(words) for _ in range(80))
+						for _ in range(5))
+	return '\n'.join([
+		'title = Post number {}\\, part {}'.format(index, index % 7),
+		'date = 2020-01-{:02d} 10:{:02d}:00'.format(index % 28 + 1, index % 60),
+		'category = {}'.format(random.choice(['news', 'blog', 'docs'])),
+		'tags = python, web, static sites',
+		'template = article',
+		'author = Someone',
+		'props = [nojson, nofeed]',
+		'styles = [main.css, print.css]',
+		'content',
+		body
+	])
+
+
+def bench_reader():
+	'''Parse a config file and 1000 page files'''
+	pages = [page_file(index) for index in range(1000)]
+	def read():
+		reader.parse(CONFIG_FILE)
+		for text in pages:
+			reader.parse(text)
+	timing = best_time(read, 3)
+	print('Config and 1000 page files: {:.2f}ms'.format(timing * 1000))
+
+
+BUILD_TEMPLATE = '''<h1>{{page.title}}</h1>{{page.content}}
+{% list pages as p limit 5: %}<p>{{p.title}}: {{p.excerpt}}</p>{% end %}'''
+
+
+def write_file(path, text):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	with open(path, 'w') as fp:
+		fp.write(text)
+
+
+def peak_memory(function):
+	tracemalloc.start()
+	with contextlib.redirect_stdout(None):
+		function()
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return peak
+
+
+def bench_build():
+	'''Build a site of 300 pages with long contents'''
+	with tempfile.TemporaryDirectory() as path:
+		write_file(os.path.join(path, 'config.me'), CONFIG_FILE)
+		for name in ('default.tpl', 'article.tpl'):
+			write_file(os.path.join(path, 'templates', name), BUILD_TEMPLATE)
+		for index in range(300):
+			head, body = page_file(index).split('\ncontent\n')
+			# about 60KB of content, with an excerpt
+			body = body.replace('\n\n', '\n<!-- more -->\n', 1) * 24
+			text = head + '\ncontent\n' + body
+			write_file(os.path.join(path, 'data', 'p{}'.format(index),
+									'page.me'), text)
+		props = reader.parse(CONFIG_FILE)
+		def build(force):
+			Site(dict(props)).generate(path, force)
+		forced = peak_memory(lambda: build(True))
+		fresh = peak_memory(lambda: build(False))
+	print('Build of 300 pages of 60KB')
+	print('  forced:     {}KB at most'.format(forced // 1024))
+	print('  up to date: {}KB at most'.format(fresh // 1024))
+
+
+def dated_pages(size):
+	random.seed(size)
+	start = datetime(2000, 1, 1)
+	pages = []
+	for index in range(size):
+		page = Page()
+		page.path = '/page{}'.format(index)
+		page.set_date(start + timedelta(minutes=random.randrange(10 ** 7)),
+					  None)
+		pages.append(page)
+	return pages
+
+
+def bench_pagelist():
+	'''Order 100k pages by date, inserting each one in a sorted
+	list and with PageList'''
+	pages = dated_pages(100000)
+	start = time.perf_counter()
+	ordered = []
+	for page in pages:
+		bisect.insort(ordered, page)
+	slow = time.perf_counter() - start
+	def build():
+		pagelist = PageList()
+		for page in pages:
+			pagelist.insert(page)
+		pagelist.sort()
+		return pagelist
+	fast = best_time(build, 1)
+	assert list(build()) == ordered
+	print('Ordering of 100000 pages')
+	print('  insort:   {:.2f}ms'.format(slow * 1000))
+	print('  PageList: {:.2f}ms ({:.1f}x)'.format(fast * 1000, slow / fast))
+
+
+BENCHMARKS = {
+	'stamper': bench_stamper,
+	'pagelist': bench_pagelist,
+	'optimizer': bench_optimizer,
+	'lexer': bench_lexer,
+	'control': bench_control,
+	'scope': bench_scope,
+	'reader': bench_reader,
+	'build': bench_build
+}
+
+if __name__ == '__main__':
+	names = sys.argv[1:] or list(BENCHMARKS)
+	for name in names:
+		BENCHMARKS[name]()
@@ -14,8 +14,9 @@ License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
 import argparse
 import sys
 import os
+import time
 
-from sitegen import utils, site, reader
+from sitegen import utils, site, reader, server, daemon, watch as watching
 from sitegen.exceptions import (
     PageExistsError,
     TemplateError,
@@ -23,7 +24,16 @@ from sitegen.exceptions import (
 )
 
 
-CONFIG_FILE = 'config.me'
+def load_site(path, resident=False):
+    config_path = os.path.join(path, site.CONFIG_FILE)
+    if not os.path.exists(config_path):
+        return
+    config_file = utils.read_file(config_path)
+    try:
+        props = reader.parse(config_file)
+    except PageValueError as err:
+        raise PageValueError('File {!r}: {}'.format(config_path, err))
+    return site.Site(props, resident=resident)
 
 
 def publish(args):
@@ -31,23 +41,122 @@ def publish(args):
     outputs a HTML for each page file'''
     path = args.path
 
-    config_path = os.path.join(path, CONFIG_FILE)
-    if not os.path.exists(config_path):
+    _site = load_site(path)
+    if not _site:
         print('No site.')
         return
-    config_file = utils.read_file(config_path)
-    try:
-        props = reader.parse(config_file)
-    except PageValueError as err:
-        raise PageValueError('File {!r}: {}'.format(config_path, err))
-    _site = site.Site(props)
 
     try:
-        pages = _site.generate(path)
+        pages = _site.generate(path, force=args.force, jobs=args.jobs,
+                               threads=args.threads)
     except (FileNotFoundError, ValueError,
             TemplateError, PageValueError) as e:
         sys.exit(e)
     print("{}\nTotal of pages read: {}".format("-" * 30, len(pages)))
+    print("Pages up to date: {}".format(_site.skipped))
+    fragments = _site.generator.fragments
+    if fragments.hits or fragments.misses:
+        print("Cached fragments: {} reused, {} rendered".format(
+            fragments.hits, fragments.misses))
+
+
+def watch(args):
+    '''Publish the site and keep it updated while files change'''
+    path = args.path
+    _site = load_site(path, resident=True)
+    if not _site:
+        print('No site.')
+        return
+    try:
+        _site.generate(path)
+    except (FileNotFoundError, ValueError,
+            TemplateError, PageValueError) as e:
+        sys.exit(e)
+    config_path = os.path.join(_site.props['base_path'], site.CONFIG_FILE)
+    watcher = watching.create_watcher(_site.props['base_path'],
+                                      args.interval, args.poll)
+    print('Watching {!r} for changes...'.format(path))
+    try:
+        while True:
+            changed = watcher.wait()
+            start = time.perf_counter()
+            try:
+                if config_path in changed:
+                    new_site = load_site(path, resident=True)
+                    if not new_site:
+                        # keep the last site until the config is back
+                        print('No config file at {!r}.'.format(path))
+                        continue
+                    _site.save()
+                    _site = new_site
+                    pages = _site.generate(path)
+                else:
+                    pages = _site.update(changed)
+            except Exception as e:
+                # keep watching, the error may be fixed by the next change
+                print(e)
+                continue
+            if pages is None:
+                continue
+            elapsed = (time.perf_counter() - start) * 1000
+            print('Updated in {:.0f}ms, pages up to date: {}/{}'.format(
+                elapsed, _site.skipped, len(pages)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        _site.save()
+
+
+def serve(args):
+    '''Serve the site, rendering each page when it is requested'''
+    path = args.path
+    if not os.path.exists(os.path.join(path, site.CONFIG_FILE)):
+        print('No site.')
+        return
+    base_url = 'http://{}:{}/'.format(args.host, args.port)
+    try:
+        preview = server.Preview(path, base_url, load_site)
+    except (FileNotFoundError, ValueError, PageValueError) as e:
+        sys.exit(e)
+    watcher = watching.create_watcher(preview.site.props['base_path'],
+                                      args.interval, args.poll)
+    server.watch_changes(preview, watcher)
+    httpd = server.create_server(preview, args.host, args.port)
+    print('Serving {!r} at {}'.format(path, base_url))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        watcher.close()
+
+
+def build_daemon(args):
+    '''Publish the site and update it on requests sent over HTTP'''
+    path = os.path.abspath(args.path)
+    _site = load_site(path, resident=True)
+    if not _site:
+        print('No site.')
+        return
+    try:
+        _site.generate(path)
+    except (FileNotFoundError, ValueError,
+            TemplateError, PageValueError) as e:
+        sys.exit(e)
+    build = daemon.BuildDaemon(_site, load_site)
+    httpd = daemon.create_server(build, args.host, args.port)
+    print('Build daemon listening at http://{}:{}/'.format(args.host,
+                                                          args.port))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        # the site is replaced when the config file changes
+        build.site.save()
 
 
 def main():
@@ -59,8 +168,42 @@ def main():
 
     parser_publish = subparsers.add_parser('publish', help='Generate HTML files')
     parser_publish.add_argument('path', nargs='?', default='.')
+    parser_publish.add_argument('--force', action='store_true',
+        help='Ignore the build manifest and regenerate every page')
+    workers = parser_publish.add_mutually_exclusive_group()
+    workers.add_argument('--jobs', '-j', type=int, default=1,
+        help='Number of processes rendering pages')
+    workers.add_argument('--threads', type=int, default=1,
+        help='Number of threads rendering pages from shared templates')
     parser_publish.set_defaults(method=publish)
 
+    parser_watch = subparsers.add_parser('watch',
+        help='Regenerate HTML files when the site changes')
+    parser_watch.add_argument('path', nargs='?', default='.')
+    parser_watch.add_argument('--poll', action='store_true',
+        help='Look for changes periodically instead of using inotify')
+    parser_watch.add_argument('--interval', type=float,
+        default=watching.POLL_INTERVAL, help='Seconds between polls')
+    parser_watch.set_defaults(method=watch)
+
+    parser_serve = subparsers.add_parser('serve',
+        help='Serve the site, rendering pages when requested')
+    parser_serve.add_argument('path', nargs='?', default='.')
+    parser_serve.add_argument('--host', default='127.0.0.1')
+    parser_serve.add_argument('--port', type=int, default=8000)
+    parser_serve.add_argument('--poll', action='store_true',
+        help='Look for changes periodically instead of using inotify')
+    parser_serve.add_argument('--interval', type=float,
+        default=watching.POLL_INTERVAL, help='Seconds between polls')
+    parser_serve.set_defaults(method=serve)
+
+    parser_daemon = subparsers.add_parser('daemon',
+        help='Keep the site in memory and rebuild it on request')
+    parser_daemon.add_argument('path', nargs='?', default='.')
+    parser_daemon.add_argument('--host', default='127.0.0.1')
+    parser_daemon.add_argument('--port', type=int, default=8001)
+    parser_daemon.set_defaults(method=build_daemon)
+
     args = parser.parse_args()
     args.method(args)
 
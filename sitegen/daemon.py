@@ -0,0 +1,127 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import os
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import site
+
+
+class BuildDaemon:
+    '''A published site kept in memory, updated on request'''
+    def __init__(self, site, loader):
+        self.site = site
+        self.base_path = site.props['base_path']
+        # returns a resident Site read from the config file at a path
+        self.loader = loader
+        self.lock = threading.Lock()
+
+    def reload(self):
+        '''Read the config file again and build the site with it'''
+        new_site = self.loader(self.base_path, resident=True)
+        if new_site is None:
+            raise FileNotFoundError('No config file at {!r}'.format(
+                self.base_path))
+        self.site.save()
+        self.site = new_site
+        self.site.generate(self.base_path)
+
+    def result(self):
+        self.site.save()
+        return {
+            'generated': self.site.generated,
+            'skipped': self.site.skipped,
+            'pages': len(self.site.generator.pagelist)
+        }
+
+    def rebuild(self, paths):
+        '''Regenerate the outputs depending on these files, given
+        as absolute paths or relative to the site'''
+        paths = [os.path.normpath(os.path.join(self.base_path, path))
+                 for path in paths]
+        config_path = os.path.join(self.base_path, site.CONFIG_FILE)
+        with self.lock:
+            if config_path in paths:
+                self.reload()
+            elif self.site.update(paths) is None:
+                # nothing the build reads has changed
+                self.site.generated = []
+                self.site.skipped = len(self.site.generator.pagelist)
+            return self.result()
+
+    def rebuild_category(self, category_id):
+        if category_id not in self.site.props.get('categories', {}):
+            return None
+        with self.lock:
+            self.site.rebuild_category(category_id)
+            return self.result()
+
+    def publish_feeds(self):
+        with self.lock:
+            self.site.publish_feeds()
+            self.site.save()
+        return {}
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        daemon = self.server.build_daemon
+        parts = [part for part in self.path.split('/') if part]
+        try:
+            body = self.read_body()
+        except ValueError as error:
+            self.reply(400, {'error': 'Invalid JSON: {}'.format(error)})
+            return
+        try:
+            if parts == ['rebuild'] and isinstance(body.get('paths'), list):
+                result = daemon.rebuild(body['paths'])
+            elif len(parts) == 2 and parts[0] == 'category':
+                result = daemon.rebuild_category(parts[1])
+            elif parts == ['feeds']:
+                result = daemon.publish_feeds()
+            else:
+                self.reply(400, {'error': 'Unknown request'})
+                return
+        except Exception as error:
+            # the daemon is still usable, the error may be fixed
+            self.reply(500, {'error': str(error)})
+            return
+        if result is None:
+            self.reply(404, {'error': 'Unknown category'})
+        else:
+            self.reply(200, result)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        body = json.loads(self.rfile.read(length).decode('utf-8'))
+        if not isinstance(body, dict):
+            raise ValueError('expected an object')
+        return body
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_server(daemon, host, port):
+    server = ThreadingHTTPServer((host, port), DaemonHandler)
+    server.build_daemon = daemon
+    return server
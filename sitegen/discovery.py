@@ -0,0 +1,74 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def scan_dir(path):
+    '''Return the subdirectory paths and file names of a directory'''
+    subdirs = []
+    files = set()
+    try:
+        with os.scandir(path or os.curdir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(os.path.join(path, entry.name))
+                else:
+                    files.add(entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return subdirs, files
+
+
+class DirectoryIndex:
+    '''The directories and files of a tree, read once'''
+    def __init__(self, exclude=None):
+        self.dirs = {}
+        self.exclude = exclude or (lambda path: False)
+
+    def scan(self, root, threads=1):
+        '''Read the whole tree, a level at a time, optionally
+        reading the directories of a level in parallel'''
+        level = [root]
+        executor = ThreadPoolExecutor(threads) if threads > 1 else None
+        try:
+            while level:
+                if executor:
+                    results = executor.map(scan_dir, level)
+                else:
+                    results = map(scan_dir, level)
+                next_level = []
+                for path, entries in zip(level, results):
+                    self.dirs[path] = entries
+                    subdirs = [d for d in entries[0] if not self.exclude(d)]
+                    next_level.extend(subdirs)
+                level = next_level
+        finally:
+            if executor:
+                executor.shutdown()
+
+    def entries(self, path):
+        if path not in self.dirs:
+            self.dirs[path] = scan_dir(path)
+        return self.dirs[path]
+
+    def subdirs(self, path):
+        return self.entries(path)[0]
+
+    def has_file(self, path, filename):
+        return filename in self.entries(path)[1]
+
+    def forget(self, path):
+        '''Drop what is known about a directory'''
+        self.dirs.pop(path, None)
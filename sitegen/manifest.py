@@ -0,0 +1,162 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import os
+import json
+import hashlib
+
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 2
+
+
+def hash_content(content):
+    '''Return a hex digest of a string or bytes value'''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def hash_data(data):
+    '''Return a stable digest of a JSON-like structure'''
+    text = json.dumps(data, sort_keys=True, default=str)
+    return hash_content(text)
+
+
+def file_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+class BuildManifest:
+    '''Remember the inputs and outputs of the last build'''
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.entries = {}
+        self.new_entries = {}
+        # files already fingerprinted and not changed since
+        self.verified = set()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != MANIFEST_VERSION:
+            return
+        self.files = data.get('files', {})
+        self.entries = data.get('entries', {})
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # files of deleted pages and templates are forgotten
+        used = set()
+        for entry in self.entries.values():
+            used.update(entry['inputs'])
+            if entry['output']:
+                used.add(entry['output'][0])
+        self.files = {path: self.files[path] for path in used
+                      if path in self.files}
+        data = {
+            'version': MANIFEST_VERSION,
+            'files': self.files,
+            'entries': self.entries
+        }
+        with open(self.path, 'w') as fp:
+            json.dump(data, fp)
+
+    def fingerprint(self, path):
+        '''Return the content hash of a file, rehashing only if its
+        modification time or size changed since last seen'''
+        if path in self.verified:
+            known = self.files.get(path)
+            return known[2] if known else None
+        self.verified.add(path)
+        stat = file_stat(path)
+        if stat is None:
+            self.files.pop(path, None)
+            return None
+        known = self.files.get(path)
+        if known and known[:2] == stat:
+            return known[2]
+        with open(path, 'rb') as fp:
+            digest = hash_content(fp.read())
+        self.files[path] = stat + [digest]
+        return digest
+
+    def invalidate(self, paths):
+        '''Check these files again on their next fingerprint'''
+        self.verified.difference_update(paths)
+
+    def rotate(self):
+        '''Make the entries of this build the reference for the next'''
+        self.entries = self.new_entries
+        self.new_entries = {}
+
+    def commit(self):
+        '''Make the entries recorded so far the reference,
+        keeping the ones not checked since the last rotation'''
+        self.entries.update(self.new_entries)
+        self.new_entries = {}
+
+    def outputs(self):
+        '''Return the names and output files of the entries of the
+        last build that have a file'''
+        return [(name, entry['output'][0])
+                for name, entry in self.entries.items() if entry['output']]
+
+    def output_state(self, output_path):
+        # outputs kept only in memory have no file to check
+        if output_path is None:
+            return None
+        return [output_path, self.fingerprint(output_path)]
+
+    def is_fresh(self, name, key, inputs, output_path, shared=None):
+        '''Check if an output is up to date with its inputs'''
+        entry = self.entries.get(name)
+        if not entry or entry['key'] != key:
+            return False
+        # build-wide data the last render has read, each
+        # checked by a function of what was recorded about it
+        shared = shared or {}
+        for shared_name, value in entry['shared'].items():
+            check = shared.get(shared_name)
+            if not check or not check(value):
+                return False
+        if entry['output'] != self.output_state(output_path):
+            return False
+        recorded = entry['inputs']
+        for path in set(inputs).union(recorded):
+            if self.fingerprint(path) != recorded.get(path):
+                return False
+        # keep it for the next build
+        self.new_entries[name] = entry
+        return True
+
+    def record(self, name, key, inputs, output_path, shared=None):
+        '''Save the fingerprints of a freshly generated output'''
+        if output_path is not None:
+            self.invalidate([output_path])
+        self.new_entries[name] = {
+            'key': key,
+            'shared': shared or {},
+            'inputs': {path: self.fingerprint(path) for path in inputs},
+            'output': self.output_state(output_path)
+        }
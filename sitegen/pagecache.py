@@ -0,0 +1,106 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import os
+import marshal
+
+from . import utils
+from .manifest import hash_content
+from .paging import PageData, PageBody, split_content
+
+
+PAGE_CACHE_FILE = 'pages.bin'
+PAGE_CACHE_VERSION = 2
+
+
+class PageDataCache:
+    '''Data parsed from page files, saved between builds'''
+    def __init__(self, path):
+        self.path = path
+        # file path: [mtime, size, file digest, parsed data without
+        # the content, [content offset, content digest, excerpt digest]]
+        self.entries = {}
+        self.changed = False
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as fp:
+                data = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if not isinstance(data, dict):
+            return
+        if data.get('version') != PAGE_CACHE_VERSION:
+            return
+        self.entries = data.get('entries', {})
+
+    def save(self, keep=None):
+        '''Write the entries of the files for which keep is true'''
+        if keep:
+            entries = {path: entry for path, entry in self.entries.items()
+                       if keep(path)}
+            self.changed = self.changed or len(entries) != len(self.entries)
+            self.entries = entries
+        if not self.changed:
+            return
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        temp_path = self.path + utils.TEMP_SUFFIX
+        with open(temp_path, 'wb') as fp:
+            marshal.dump({'version': PAGE_CACHE_VERSION,
+                          'entries': self.entries}, fp)
+        os.replace(temp_path, self.path)
+        self.changed = False
+
+    def parse(self, path, parse):
+        '''Return a copy of the data of a file, calling parse
+        on its text only if the file has changed. The content
+        is left in the file, to be read when used'''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # let the reader raise the usual error
+            return PageData(parse(utils.read_file(path)))
+        entry = self.entries.get(path)
+        state = [stat.st_mtime_ns, stat.st_size]
+        if entry and entry[:2] == state:
+            return self.page_data(path, entry)
+        text = utils.read_file(path)
+        digest = hash_content(text)
+        if not entry or entry[2] != digest:
+            entry = [None, None, digest] + split_body(parse(text), text)
+        entry[:2] = state
+        self.entries[path] = entry
+        self.changed = True
+        return self.page_data(path, entry)
+
+    def page_data(self, path, entry):
+        body = None
+        if entry[4]:
+            offset, content_digest, excerpt_digest = entry[4]
+            body = PageBody(path, offset, (content_digest, excerpt_digest))
+        return PageData(entry[3], body)
+
+
+def split_body(data, text):
+    '''Return the data parsed from a page file without its content,
+    and the position and digests of the content'''
+    content = data.get('content')
+    if not isinstance(content, str):
+        return [data, None]
+    del data['content']
+    # the content is the stripped end of the text
+    offset = len(text.rstrip()) - len(content)
+    excerpt, content = split_content(content)
+    return [data, [offset, hash_content(content), hash_content(excerpt)]]
@@ -14,7 +14,9 @@ License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
 import os
 import re
 import bisect
-from datetime import datetime
+import functools
+from array import array
+from datetime import datetime, timedelta, timezone
 from . import utils
 from .exceptions import PageValueError
 
@@ -22,18 +24,110 @@ from .exceptions import PageValueError
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 THUMB_FILENAME = 'thumb.png'
 EXCERPT_RE = r'<!--\s*more\s*-->'
+EPOCH = datetime(1970, 1, 1)
+UTC_EPOCH = EPOCH.replace(tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+# page data read from the page file when used
+BODY_KEYS = ('content', 'excerpt')
+# excerpts of page files kept after being read by listings
+EXCERPT_CACHE_SIZE = 32
+
+
+def timestamp(date):
+    '''Microseconds since the epoch, ordered like the dates'''
+    epoch = EPOCH if date.tzinfo is None else UTC_EPOCH
+    return (date - epoch) // MICROSECOND
+
+
+def split_content(content):
+    '''Return the excerpt of a page content and the content
+    without the excerpt marker'''
+    return (re.split(EXCERPT_RE, content, 1)[0],
+            re.sub(EXCERPT_RE, '', content))
+
+
+def read_content(path, offset):
+    '''Return the content of a page file starting at offset'''
+    return utils.read_file(path)[offset:].strip()
+
+
+@functools.lru_cache(maxsize=EXCERPT_CACHE_SIZE)
+def read_excerpt(path, offset, digest):
+    return split_content(read_content(path, offset))[0]
+
+
+class PageBody:
+    '''The content of a page file, read only when used'''
+    def __init__(self, path, offset, digests):
+        self.path = path
+        # position of the content in the text of the file
+        self.offset = offset
+        # digests of the content and the excerpt
+        self.digests = tuple(digests)
+
+    def read(self, key):
+        '''Return the content or the excerpt'''
+        if key == 'excerpt':
+            return read_excerpt(self.path, self.offset, self.digests[1])
+        return split_content(read_content(self.path, self.offset))[1]
+
+
+class PageData(dict):
+    '''Data of a page, reading its content and excerpt from
+    the page file only when they are used'''
+    __slots__ = ('body',)
+
+    def __init__(self, data=(), body=None):
+        super().__init__(data)
+        self.body = body
+
+    def __missing__(self, key):
+        if self.body is None or key not in BODY_KEYS:
+            raise KeyError(key)
+        return self.body.read(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (
+            self.body is not None and key in BODY_KEYS)
+
+    def get(self, key, default=None):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        if self.body is not None and key in BODY_KEYS:
+            return self.body.read(key)
+        return default
+
+    def copy(self):
+        return PageData(self, self.body)
+
+    def read(self):
+        '''Return a dict of the data with the content read'''
+        data = dict(self)
+        for key in BODY_KEYS:
+            if key in self:
+                data[key] = self[key]
+        return data
 
 
 class Page():
     '''Define a page'''
+    # read directly by template lookups
+    template_items = 'data'
+
     def __init__(self):
         self.children = PageList()
         self.props = []
         self.path = ''
         self.styles = []
         self.scripts = []
+        self.tags = []
         self.template = ''
-        self.data = {}
+        self.data = PageData()
+        self.digest = None
+        # set when the page file has no date and the build time is used
+        self.default_date = False
+        # digests of the build data, by use, with the data
+        self.digests = {}
 
     def __le__(self, other):
         return self['date'] <= other['date']
@@ -60,7 +154,7 @@ class Page():
         del self.data[key]
 
     def __contains__(self, key):
-        return key in self.data.keys()
+        return key in self.data
 
     def initialize(self, params, options):
         for key in params.keys():
@@ -94,6 +188,11 @@ class Page():
         '''Books can have some different properties'''
         self.props = self.convert_param_list(props)
 
+    def set_tags(self, tags, options):
+        '''Tags are kept as written for the templates'''
+        self.tags = self.convert_param_list(tags)
+        self.data['tags'] = tags
+
     def set_styles(self, styles, opts):
         '''To get some extra style'''
         styles = self.convert_param_list(styles)
@@ -121,32 +220,65 @@ class Page():
         return 'nojson' not in self.props
 
 
+def page_date(page):
+    return page.data['date']
+
+
 class PageList:
     '''Define an ordered list of pages'''
     def __init__(self):
         self.ordered_pages = []
         self.page_dict = {}
+        # dates of the ordered pages for bisect queries, made when needed
+        self.timestamps = None
+        self.unsorted = False
+
+    def sort(self):
+        '''Put the inserted pages in date order, keeping the
+        insertion order of pages with the same date'''
+        if self.unsorted:
+            self.ordered_pages.sort(key=page_date)
+            self.timestamps = None
+            self.unsorted = False
 
     def __iter__(self):
-        for page in self.ordered_pages:
-            yield page
+        self.sort()
+        return iter(self.ordered_pages)
 
     def __len__(self):
         return len(self.ordered_pages)
 
     def __setitem__(self, key, value):
+        self.sort()
         self.ordered_pages[key] = value
+        self.timestamps = None
 
     def __getitem__(self, key):
+        self.sort()
         return self.ordered_pages[key]
 
     def __delitem__(self, key):
+        self.sort()
         del self.ordered_pages[key]
+        self.timestamps = None
 
     def reverse(self):
         '''To reverse the list of books'''
+        self.sort()
+        self.timestamps = None
         return self.ordered_pages.reverse()
 
+    def between(self, start, end):
+        '''Return the pages dated from start until before end,
+        the list being in date order'''
+        self.sort()
+        if self.timestamps is None:
+            self.timestamps = array('q', [timestamp(page.data['date'])
+                                          for page in self.ordered_pages])
+        first = bisect.bisect_left(self.timestamps, timestamp(start))
+        last = bisect.bisect_left(self.timestamps, timestamp(end))
+        return self.ordered_pages[first:last]
+
     def page_struct(self, index):
         '''To create a tag to find books'''
         page = self.ordered_pages[index]
@@ -157,6 +289,7 @@ class PageList:
 
     def paginate(self):
         '''To sort books in shelves'''
+        self.sort()
         length = len(self.ordered_pages)
         for index, page in enumerate(self.ordered_pages):
             page['first'] = self.page_struct(0)
@@ -168,23 +301,81 @@ class PageList:
 
     def insert(self, page):
         '''To insert book in right position by date'''
-        bisect.insort(self.ordered_pages, page)
+        # sorted once when the list is read
+        self.ordered_pages.append(page)
         self.page_dict[page.path] = page
+        self.unsorted = True
+
+
+class PageListing:
+    '''A view of the listed pages that remembers which were read'''
+    def __init__(self, pages):
+        self.pages = pages
+        # number of pages read from each end and if the length was
+        self.front = 0
+        self.back = 0
+        self.sized = False
+
+    def usage(self):
+        '''Return how the listing was read, or None if it wasn't'''
+        if self.front or self.back or self.sized:
+            return [self.front, self.back, self.sized]
+
+    def merge_usage(self, usage):
+        '''Count the reads described by another usage as done'''
+        front, back, sized = usage
+        self.front = max(self.front, front)
+        self.back = max(self.back, back)
+        self.sized = self.sized or sized
+
+    def __iter__(self):
+        for index, page in enumerate(self.pages):
+            self.front = max(self.front, index + 1)
+            yield page
+        # reading past the last page tells the length
+        self.sized = True
+
+    def __reversed__(self):
+        for index, page in enumerate(reversed(self.pages)):
+            self.back = max(self.back, index + 1)
+            yield page
+        self.sized = True
+
+    def __len__(self):
+        self.sized = True
+        return len(self.pages)
+
+    def __getitem__(self, key):
+        if isinstance(key, int) and key < 0:
+            self.back = max(self.back, -key)
+        elif isinstance(key, int):
+            self.front = max(self.front, key + 1)
+        else:
+            self.front = len(self.pages)
+        return self.pages[key]
+
+    def __contains__(self, item):
+        self.front = len(self.pages)
+        return item in self.pages
+
+    def __str__(self):
+        self.front = len(self.pages)
+        return str(self.pages)
 
 
 class PageBuilder:
-    def __init__(self, env):
+    def __init__(self, env, index):
         self.env = env
+        self.index = index
 
     def build_url_from_path(self, path):
         base_path = self.env['base_path'] + '/data'
         resource = path.replace(base_path, '').strip('/')
         return utils.urljoin(self.env['base_url'], resource)
 
-    def build_thumbnail(self, page_url):
-        thumb_filepath = os.path.join(page_url, THUMB_FILENAME)
-        if os.path.exists(thumb_filepath):
-            return thumb_filepath
+    def build_thumbnail(self, page_path, page_url):
+        if self.index.has_file(page_path, THUMB_FILENAME):
+            return os.path.join(page_url, THUMB_FILENAME)
         # TODO: return default thumbnail
 
     def build_date(self, date_string, date_format):
@@ -199,9 +390,11 @@ class PageBuilder:
         return date
 
     def build_content(self, page_data):
+        if getattr(page_data, 'body', None):
+            # read from the page file when used
+            return
         content = page_data.get('content', '')
-        page_data['excerpt'] = re.split(EXCERPT_RE, content, 1)[0]
-        page_data['content'] = re.sub(EXCERPT_RE, '', content)
+        page_data['excerpt'], page_data['content'] = split_content(content)
 
     def build_breadcrumbs(self, parent_page, page_data):
         links = []
@@ -229,9 +422,10 @@ class PageBuilder:
 
         page_data['url'] = page_url
         page.image = page_data.get('image')
-        page_data['thumb'] = self.build_thumbnail(page_url)
+        page_data['thumb'] = self.build_thumbnail(page.path, page_url)
         page_data['breadcrumbs'] = self.build_breadcrumbs(parent_page, page_data)
 
+        page.default_date = not page_data.get('date')
         page_data['date'] = self.build_date(page_data.get('date'), options.get('date_format', ''))
 
         self.build_content(page_data)
@@ -240,6 +434,6 @@ class PageBuilder:
             page.initialize(page_data, options)
         except ValueError as error:
             raise ValueError('{} at page {!r}'.format(error, page.path))
-
+        page.data.body = getattr(page_data, 'body', None)
 
         return page
\ No newline at end of file
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .template import TemplateRegistry
+from .stamper.cache import IncludeCache
+
+
+# state inherited by each worker process
+_worker = {}
+
+
+def _init_worker(generator, pages, env):
+    _worker['generator'] = generator
+    _worker['pages'] = pages
+    # templates are parsed once per worker and reused between batches
+    templates = TemplateRegistry(env['templates'].tree_cache)
+    _worker['env'] = dict(env, templates=templates,
+                          include_cache=IncludeCache())
+    # counted by the main process already
+    env['fragment_cache'].take_updates()
+
+
+def _publish_batch(indexes):
+    generator = _worker['generator']
+    pages = _worker['pages']
+    results = []
+    for index in indexes:
+        dependencies, listing_usage, tags_read = generator.publish_page(
+            pages[index], _worker['env'])
+        results.append((sorted(dependencies), listing_usage, tags_read))
+    # fragments rendered by this worker are kept by the main process
+    return results, _worker['env']['fragment_cache'].take_updates()
+
+
+def batch_by_template(pages, jobs):
+    '''Split the page indexes in batches of pages sharing a template'''
+    groups = {}
+    for index, page in enumerate(pages):
+        groups.setdefault(page.template, []).append(index)
+    batches = []
+    for indexes in groups.values():
+        size = -(-len(indexes) // jobs)
+        for start in range(0, len(indexes), size):
+            batches.append(indexes[start:start + size])
+    return batches
+
+
+def publish_pages(generator, pages, env, jobs):
+    '''Render and write pages in a pool of processes, returning
+    the results of SiteGenerator.publish_page in page order'''
+    results = [None] * len(pages)
+    if not pages:
+        return results
+    batches = batch_by_template(pages, jobs)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(generator, pages, env)) as executor:
+        for indexes, (batch, updates) in zip(batches, executor.map(
+                _publish_batch, batches)):
+            for index, result in zip(indexes, batch):
+                results[index] = result
+            env['fragment_cache'].merge(updates)
+    return results
+
+
+def publish_pages_threaded(generator, pages, env, threads):
+    '''Render and write pages in a pool of threads sharing the
+    environment and its template cache'''
+    def publish(page):
+        return generator.publish_page(page, env)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(publish, pages))
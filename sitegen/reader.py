@@ -11,6 +11,9 @@ License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
 ===============================================================================
 '''
 
+import re
+from collections import namedtuple
+
 from .exceptions import PageValueError
 
 NEWLINE = '\n'
@@ -36,172 +39,230 @@ KEYCHARS = ''.join([
     TOK_CLOSEGROUP
 ])
 
-def _create_env(text):
-    data = {}
-    return {
-        'index': 0,
-        'text': text,
-        'tokens': [],
-        'current_token': None,
-        'data': data,
-        'stack': [data]
-    }
-
-def _create_token(type, value, line=1, column=0):
-    return {
-        'type': type,
-        'value': value,
-        'line': line,
-        'column': column
-    }
-
-def _tokenize(text):
-    line = 1
+# the characters up to a special one, and the special one
+CHUNK_REGEX = re.compile('([^{0}]*)([{0}]|$)'.format(
+    re.escape(KEYCHARS + TOK_ESCAPE)))
+
+# characters of a name or value outside lists
+PLAIN = '[^{}]'.format(
+    re.escape(KEYCHARS.replace(TOK_COMMA, '') + TOK_ESCAPE))
+
+# an escaped character, other than a newline
+ESCAPED = r'\\[{}]'.format(re.escape(KEYCHARS.replace(NEWLINE, '')))
+ESCAPE_REGEX = re.compile(r'\\(.)')
+
+# lines read without tokenizing: a rule with a name or a list as value
+RULE_TEXT = r'{0}*(?:{1}{0}*)*'.format(PLAIN, ESCAPED)
+RULE_LINE_REGEX = re.compile(r'({0})=({0})$'.format(RULE_TEXT))
+LIST_LINE_REGEX = re.compile(r'({0}+)=\s*\[({0}*)\]\s*$'.format(PLAIN))
+
+Token = namedtuple('Token', 'type value line column')
+
+EOF_TOKEN = Token(TOK_EOF, TOK_EOF, 1, 0)
+
+
+def _tokenize(text, start=0, line=1):
     column = 0
     cache = []
     tokens = []
     inlist = False
-    text = text.strip()
+    if not start:
+        text = text.strip()
     escape = False
-    for index, char in enumerate(text):
+    for match in CHUNK_REGEX.finditer(text, start):
+        chunk, char = match.groups()
+        if chunk:
+            cache.append(chunk)
+            column += len(chunk)
+        if not char:
+            break
         if char == TOK_ESCAPE:
             escape = True
             continue
-        if char in KEYCHARS and escape:
+        if escape or not inlist and char == TOK_COMMA:
             cache.append(char)
             column += 1
             escape = False
             continue
-        if char not in KEYCHARS or not inlist and char == TOK_COMMA:
-            cache.append(char)
-            column += 1
-            continue
-        name = ''.join(cache).strip()
-        inlist = {
-            TOK_OPENLIST: True,
-            TOK_CLOSELIST: False
-        }.get(char, inlist)
+        name = cache[0].strip() if len(cache) == 1 else ''.join(cache).strip()
+        if char == TOK_OPENLIST:
+            inlist = True
+        elif char == TOK_CLOSELIST:
+            inlist = False
         if name == TOK_TEXT:
-            token = _create_token(TOK_TEXT, text[index:].strip(), line, column)
-            tokens.append(token)
+            tokens.append(Token(TOK_TEXT, text[match.end(1):].strip(),
+                                line, column))
             return tokens
         if name:
-            tokens.append(_create_token(TOK_NAME, name, line, column))
+            tokens.append(Token(TOK_NAME, name, line, column))
         if char == NEWLINE:
             line += 1
             column = 0
         else:
             column += 1
-            tokens.append(_create_token(char, char, line, column))
+            tokens.append(Token(char, char, line, column))
         cache = []
 
     # remaining chars
     name = ''.join(cache).strip()
     if name:
-        tokens.append(_create_token(TOK_NAME, name, line, column))
+        tokens.append(Token(TOK_NAME, name, line, column))
     return tokens
 
-def _error(env, msg):
-    token = env['current_token']
-    raise PageValueError('{} at line {}, column {}'.format(
-        msg, token['line'], token['column']))
-
-def _next_token(env):
-    env['index'] += 1
-    try:
-        next = env['tokens'][env['index']]
-    except IndexError:
-        next = _create_token(TOK_EOF, TOK_EOF)
-    env['current_token'] = next
-    return next
-
-def _consume(env, expected):
-    token = env['current_token']
-    if token['type'] == TOK_EOF:
-        return
-    if token['type'] != expected:
-        _error(env, 'Expected a {!r}'.format(expected))
-    _next_token(env)
-
-def _parse_group(env):
-    rules = {}
-    env['stack'].append(rules)
-    while env['current_token']['type'] not in (TOK_CLOSEGROUP, TOK_EOF):
-        _parse_rule(env)
-    _consume(env, TOK_CLOSEGROUP)
-    env['stack'].pop()
-    return rules
-
-def _parse_list(env):
-    names = []
-    while True:
-        token = env['current_token']
-        if token['type'] == TOK_CLOSELIST:
-            _next_token(env)
-            break
-        if token['type'] == TOK_NAME:
-            names.append(token['value'])
-            _next_token(env)
+
+class _Parser:
+    def __init__(self, tokens, data=None):
+        self.tokens = tokens
+        self.index = 0
+        self.current_token = tokens[0] if tokens else EOF_TOKEN
+        self.data = {} if data is None else data
+        self.stack = [self.data]
+
+    def error(self, msg):
+        token = self.current_token
+        raise PageValueError('{} at line {}, column {}'.format(
+            msg, token.line, token.column))
+
+    def next_token(self):
+        self.index += 1
+        try:
+            next = self.tokens[self.index]
+        except IndexError:
+            next = EOF_TOKEN
+        self.current_token = next
+        return next
+
+    def consume(self, expected):
+        type = self.current_token.type
+        if type == TOK_EOF:
+            return
+        if type != expected:
+            self.error('Expected a {!r}'.format(expected))
+        self.next_token()
+
+    def parse_group(self):
+        rules = {}
+        self.stack.append(rules)
+        while self.current_token.type not in (TOK_CLOSEGROUP, TOK_EOF):
+            self.parse_rule()
+        self.consume(TOK_CLOSEGROUP)
+        self.stack.pop()
+        return rules
+
+    def parse_list(self):
+        names = []
+        while True:
+            token = self.current_token
+            if token.type == TOK_CLOSELIST:
+                self.next_token()
+                break
+            if token.type == TOK_NAME:
+                names.append(token.value)
+                self.next_token()
+            else:
+                self.error('Expected a name, got {!r}'.format(token.value))
+            token = self.current_token
+            if token.type == TOK_COMMA:
+                self.next_token()
+                continue
+            elif token.type == TOK_CLOSELIST:
+                self.next_token()
+                break
+            else:
+                self.error('Invalid syntax')
+        return names
+
+    def parse_value(self):
+        token = self.current_token
+        if token.type == TOK_NAME:
+            value = token.value
+            self.next_token()
+        elif token.type == TOK_OPENLIST:
+            self.next_token()
+            value = self.parse_list()
+        elif token.type == TOK_OPENGROUP:
+            self.next_token()
+            value = self.parse_group()
         else:
-            _error(env, 'Expected a name, got {!r}'.format(token['value']))
-        token = env['current_token']
-        if token['type'] == TOK_COMMA:
-            token = _next_token(env)
-            continue
-        elif token['type'] == TOK_CLOSELIST:
-            _next_token(env)
-            break
+            self.error('Invalid value format')
+        return value
+
+    def parse_rule(self):
+        token = self.current_token
+        if token.type not in (TOK_NAME, TOK_TEXT):
+            self.error('Expected a name, got {!r}'.format(token.value))
+        name = token.value
+        if token.type == TOK_TEXT:
+            if len(self.stack) > 1:
+                self.error('Wrong syntax')
+            self.data[TOK_TEXT] = token.value
+            self.next_token()
+            return
+        token = self.next_token()
+        if token.type == TOK_ASSIGN:
+            self.next_token()
+            value = self.parse_value()
+            self.stack[-1][name] = value
+        elif token.type == TOK_EOF:
+            self.next_token()
+            return
         else:
-            _error(env, 'Invalid syntax')
-    return names
-
-def _parse_value(env):
-    token = env['current_token']
-    if token['type'] == TOK_NAME:
-        value = token['value']
-        _next_token(env)
-    elif token['type'] == TOK_OPENLIST:
-        _next_token(env)
-        value = _parse_list(env)
-    elif token['type'] == TOK_OPENGROUP:
-        _next_token(env)
-        value = _parse_group(env)
-    else:
-        _error(env, 'Invalid value format')
-    return value
-
-def _parse_rule(env):
-    token = env['current_token']
-    if token['type'] not in (TOK_NAME, TOK_TEXT):
-        _error(env, 'Expected a name, got {!r}'.format(token['value']))
-    name = token['value']
-    if token['type'] == TOK_TEXT:
-        if len(env['stack']) > 1:
-            _error(env, 'Wrong syntax')
-        env['data'][TOK_TEXT] = token['value']
-        _next_token(env)
-        return
-    token = _next_token(env)
-    if token['type'] == TOK_ASSIGN:
-        _next_token(env)
-        value = _parse_value(env)
-        env['stack'][-1][name] = value
-    elif token['type'] == TOK_EOF:
-        _next_token(env)
-        return
-    else:
-        _error(env, 'Invalid syntax')
-
-def _parse_ruleset(env):
-    while env['current_token']['type'] not in (TOK_EOF, TOK_CLOSEGROUP):
-        _parse_rule(env)
-    return env['data']
+            self.error('Invalid syntax')
+
+    def parse_ruleset(self):
+        while self.current_token.type not in (TOK_EOF, TOK_CLOSEGROUP):
+            self.parse_rule()
+        return self.data
+
+
+def _read_line(line):
+    '''Return the (name, value) of a simple rule line, or None'''
+    match = RULE_LINE_REGEX.match(line)
+    if match:
+        name, value = match.groups()
+        if TOK_ESCAPE in line:
+            name = ESCAPE_REGEX.sub(r'\1', name)
+            value = ESCAPE_REGEX.sub(r'\1', value)
+        name, value = name.strip(), value.strip()
+        if name and value and TOK_TEXT not in (name, value):
+            return name, value
+        return None
+    match = LIST_LINE_REGEX.match(line)
+    if match:
+        name, items = match.group(1).strip(), match.group(2)
+        values = [value.strip() for value in items.split(TOK_COMMA)]
+        if not items.strip():
+            values = []
+        if name and name != TOK_TEXT and all(values) \
+                and TOK_TEXT not in values:
+            return name, values
+    return None
+
 
 def parse(text):
     if not len(text.strip()):
         return {}
-    env = _create_env(text)
-    tokens = _tokenize(text)
-    env['tokens'] = tokens
-    env['current_token'] = tokens[0]
-    return _parse_ruleset(env)
+    text = text.strip()
+    data = {}
+    start = 0
+    line = 1
+    # simple lines are read directly, the tokens are
+    # only used from the first line needing them
+    while True:
+        end = text.find(NEWLINE, start)
+        if end == -1:
+            end = len(text)
+        content = text[start:end]
+        if content.strip() == TOK_TEXT and end < len(text):
+            data[TOK_TEXT] = text[end:].strip()
+            return data
+        rule = _read_line(content) if content.strip() else ()
+        if rule is None:
+            break
+        if rule:
+            data[rule[0]] = rule[1]
+        if end == len(text):
+            return data
+        start = end + 1
+        line += 1
+    return _Parser(_tokenize(text, start, line), data).parse_ruleset()
@@ -0,0 +1,205 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import os
+import threading
+import mimetypes
+from urllib.parse import urlsplit, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from . import site
+from .manifest import BuildManifest, hash_content
+
+
+HTML_TYPE = 'text/html; charset=utf-8'
+FEED_TYPE = 'application/rss+xml; charset=utf-8'
+# page and config files, read by builds and never published
+DATA_EXT = '.me'
+
+
+class Preview:
+    '''Pages of a site rendered when they are requested and kept
+    in memory until the files they were made from change'''
+    def __init__(self, path, base_url, loader):
+        self.path = path
+        self.base_url = base_url
+        # returns a resident Site read from the config file at a path
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        self.site = self.loader(self.path, resident=True)
+        self.site.setup(self.path, self.base_url)
+        # never saved, the outputs it describes are in memory
+        self.site.manifest = BuildManifest(None)
+        self.outputs = {}
+        self.stale = True
+
+    def invalidate(self, paths):
+        '''Forget what was read from changed files'''
+        with self.lock:
+            base_path = self.site.props['base_path']
+            if os.path.join(base_path, site.CONFIG_FILE) in paths:
+                self.reload()
+            elif self.site.invalidate(paths):
+                self.stale = True
+
+    def refresh(self):
+        '''Read the pages again if some files changed'''
+        if not self.stale:
+            return
+        self.pages, self.env = self.site.read()
+        self.listing = site.ListingDigest(self.env['pages'])
+        generator = self.site.generator
+        self.site_key = generator.site_key(self.env)
+        generator.fragments.start(generator.fragments_key(self.env,
+                                                          self.listing))
+        self.stale = False
+
+    def render_page(self, page):
+        '''Return the HTML of a page and its ETag, rendering it
+        only if it is outdated'''
+        generator = self.site.generator
+        manifest = self.site.manifest
+        key = generator.page_key(page, self.site_key)
+        inputs = generator.page_inputs(page)
+        shared = generator.shared_checks(self.listing)
+        if page.path in self.outputs and manifest.is_fresh(page.path, key,
+                                                           inputs, None,
+                                                           shared):
+            manifest.commit()
+            return self.outputs[page.path]
+        output, result = generator.render_page(page, self.env)
+        generator.record_page(page, key, manifest, self.listing, result, None)
+        manifest.commit()
+        body = output.encode('utf-8')
+        self.outputs[page.path] = (body, '"{}"'.format(hash_content(body)))
+        return self.outputs[page.path]
+
+    def render_feed(self):
+        generator = self.site.generator
+        env = {'site': self.site.props, 'templates': generator.templates,
+               'include_cache': generator.include_cache,
+               'fragment_cache': generator.fragments}
+        template, _, _ = generator.prepare_feed(env, generator.pagelist, 'rss')
+        body = template.render(env).encode('utf-8')
+        return body, '"{}"'.format(hash_content(body))
+
+    def feed_path(self):
+        generator = self.site.generator
+        dirname = self.site.props.get('feed_dir', site.FEED_DIR)
+        return os.path.join(generator.base_path, dirname, 'rss.xml')
+
+    def is_published(self, path):
+        '''Check if a file is published with the site: a file of the
+        data directory, out of blocked, template and cache directories,
+        that is not a page or config file'''
+        generator = self.site.generator
+        props = self.site.props
+        data_path = self.site.data_path()
+        if not path.startswith(data_path + os.path.sep):
+            return False
+        if path.endswith(DATA_EXT) or generator.is_output(path):
+            return False
+        hidden = [generator.templates_dir(), os.path.join(
+            generator.base_path, props.get('cache_dir', site.CACHE_DIR))]
+        if any(path.startswith(dirname + os.path.sep) for dirname in hidden):
+            return False
+        dirs = os.path.relpath(os.path.dirname(path), data_path)
+        blocked_dirs = props.get('blocked_dirs') or []
+        return not set(dirs.split(os.path.sep)).intersection(blocked_dirs)
+
+    def read_static(self, path):
+        stat = os.stat(path)
+        with open(path, 'rb') as fp:
+            body = fp.read()
+        etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+        return body, etag
+
+    def get(self, url):
+        '''Return the content type, body and ETag of the resource at
+        an URL path, or None if there is none'''
+        url_path = unquote(urlsplit(url).path)
+        parts = [part for part in url_path.split('/')
+                 if part and part not in ('.', '..')]
+        with self.lock:
+            self.refresh()
+            generator = self.site.generator
+            page_path = os.path.join(self.site.data_path(), *parts)
+            page = generator.pagelist.page_dict.get(page_path)
+            if page and 'nohtml' not in page.props:
+                return (HTML_TYPE,) + self.render_page(page)
+            file_path = os.path.join(generator.base_path, *parts)
+            if file_path == self.feed_path() and len(generator.pagelist):
+                return (FEED_TYPE,) + self.render_feed()
+        for path in (page_path, file_path):
+            if os.path.isfile(path) and self.is_published(path):
+                content_type = mimetypes.guess_type(path)[0]
+                return ((content_type or 'application/octet-stream'),
+                        ) + self.read_static(path)
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def respond(self, send_body):
+        try:
+            resource = self.server.preview.get(self.path)
+        except Exception as error:
+            # show template and page errors in the browser
+            self.send_error(500, explain=str(error))
+            return
+        if resource is None:
+            self.send_error(404)
+            return
+        content_type, body, etag = resource
+        etags = self.headers.get('If-None-Match', '')
+        if etag in [tag.strip() for tag in etags.split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+
+def watch_changes(preview, watcher):
+    '''Invalidate the preview in a background thread as files change'''
+    def run():
+        while True:
+            changed = watcher.wait()
+            try:
+                preview.invalidate(changed)
+            except Exception as error:
+                # keep watching, the error may be fixed by the next change
+                print(error)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def create_server(preview, host, port):
+    server = ThreadingHTTPServer((host, port), PreviewHandler)
+    server.preview = preview
+    return server
@@ -16,13 +16,25 @@ from datetime import datetime
 
 from . import reader
 from . import utils
-from .template import HTMLTemplate, Template
-from .paging import PageList, PageBuilder
+from . import parallel
+from .template import HTMLTemplate, Template, TemplateRegistry
+from .paging import (Page, PageData, PageList, PageBuilder, PageListing,
+                     THUMB_FILENAME)
 from .categorization import CategoryList
+from .tagging import TagIndex, TagUsage
+from .manifest import BuildManifest, MANIFEST_FILE, hash_data, file_stat
+from .discovery import DirectoryIndex
+from .pagecache import PageDataCache, PAGE_CACHE_FILE
+from .stamper.cache import TreeCache, IncludeCache, FragmentCache
+from .stamper.scope import Scope
 from .exceptions import (PageValueError, TemplateError)
 
 
 BASE_URL = '//localhost/'
+CONFIG_FILE = 'config.me'
+CACHE_DIR = '.sitegen'
+TREE_CACHE_DIR = 'templates'
+FRAGMENT_CACHE_FILE = 'fragments.bin'
 STATIC_DIR = 'data/static'
 TEMPLATES_DIR = 'templates'
 TEMPLATES_EXT = 'tpl'
@@ -32,36 +44,104 @@ IMAGE_FILE = 'image.png'
 FEED_FILE = 'feed.xml'
 FEED_DIR = 'data/feed'
 FEED_NUM = 8
+TAG_DIR = 'data/tags'
 HTML_FILENAME = 'index.html'
 MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(MODEL_DIR, '../data')
 FORBIDDEN_DIRS = set((STATIC_DIR, TEMPLATES_DIR, FEED_DIR))
+# page data set again by every build, after the page is built
+BUILD_KEYS = ('category', 'first', 'next', 'prev', 'last')
+# page data set from the date, which changes every build for undated pages
+DATE_KEYS = ('date', 'year', 'month', 'day')
 
 
 class SiteGenerator:
-    def __init__(self, props=None):
+    def __init__(self, props=None, resident=False):
         self.pagelist = PageList()
         self.category_list = CategoryList()
+        self.tag_index = TagIndex()
+        self.tags_key = None
+        self.templates_key = None
         self.props = props or {}
         self.base_path = self.props.get('base_path', '')
-        self.page_builder = PageBuilder(self.props)
+        self.index = DirectoryIndex(exclude=self.is_forbidden_dir)
+        self.page_builder = PageBuilder(self.props, self.index)
+        cache_dir = self.props.get('cache_dir', CACHE_DIR)
+        self.tree_cache = TreeCache(os.path.join(self.base_path, cache_dir,
+                                                 TREE_CACHE_DIR))
+        self.templates = TemplateRegistry(self.tree_cache)
+        self.include_cache = IncludeCache()
+        persistent = self.props.get('fragment_cache') == 'persistent'
+        self.fragments = FragmentCache(os.path.join(self.base_path, cache_dir,
+                                                    FRAGMENT_CACHE_FILE),
+                                       persistent)
+        self.page_data = PageDataCache(os.path.join(self.base_path, cache_dir,
+                                                    PAGE_CACHE_FILE))
+        # parsed page files and built pages, only kept by
+        # resident generators to be reused by the next builds
+        self.page_cache = {} if resident else None
+        self.page_objects = {} if resident else None
+
+    def reset(self):
+        '''Forget the pages read by a previous build'''
+        self.pagelist = PageList()
+        self.category_list = CategoryList()
+        self.tag_index = TagIndex()
+        self.tags_key = None
+
+    def invalidate(self, paths):
+        '''Forget what was read from changed files'''
+        templates_dir = self.templates_dir()
+        for path in paths:
+            if self.page_cache is not None:
+                self.page_cache.pop(path, None)
+                self.page_objects.pop(os.path.dirname(path), None)
+            self.index.forget(path)
+            self.index.forget(os.path.dirname(path))
+            if path.startswith(templates_dir):
+                self.templates.clear()
+                self.templates_key = None
+        self.include_cache.refresh()
+
+    def is_output(self, path):
+        '''Check if a path is written by the build itself'''
+        html_filename = self.props.get('html_filename', HTML_FILENAME)
+        basename = os.path.basename(path)
+        if basename in (html_filename, html_filename + utils.TEMP_SUFFIX):
+            return True
+        dirs = (self.props.get('feed_dir', FEED_DIR),
+                self.props.get('tag_dir', TAG_DIR),
+                self.props.get('cache_dir', CACHE_DIR))
+        for dirname in dirs:
+            dirname = os.path.join(self.base_path, dirname)
+            if path == dirname or path.startswith(dirname + os.path.sep):
+                return True
+        return False
+
+    def scan(self, path, threads=1):
+        '''Read the directory tree of the site at once'''
+        self.index.scan(path, threads)
 
     def read_page(self, path):
         '''Return the page data specified by path'''
         data_file_path = self.props.get('data_file', DATA_FILE)
-        file_path = os.path.join(path, data_file_path)
-        if not os.path.exists(file_path):
+        if not self.index.has_file(path, data_file_path):
             return
+        file_path = os.path.join(path, data_file_path)
 
-        try:
-            page_data = reader.parse(utils.read_file(file_path))
-        except PageValueError as err:
-            raise PageValueError('In file {!r}: {}'.format(file_path, err))
+        if self.page_cache and file_path in self.page_cache:
+            page_data = self.page_cache[file_path].copy()
+        else:
+            try:
+                page_data = self.page_data.parse(file_path, reader.parse)
+            except PageValueError as err:
+                raise PageValueError('In file {!r}: {}'.format(file_path, err))
+            if self.page_cache is not None:
+                self.page_cache[file_path] = page_data.copy()
         page_data['path'] = path
 
         image_file_name = self.props.get('image_file', IMAGE_FILE)
-        image_path = os.path.join(path, image_file_name)
-        if os.path.exists(image_path):
+        if self.index.has_file(path, image_file_name):
             page_data['image'] = image_file_name
         return page_data
 
@@ -83,10 +163,8 @@ class SiteGenerator:
             })
         return render_list
 
-    def build_page(self, page_data, parent_page):
-        page = self.page_builder.build(page_data, parent_page)
-
-        category_id = page_data.get('category')
+    def categorize_page(self, page):
+        category_id = page.category_id
         category = self.category_list[category_id]
 
         if category_id in self.props.get('categories', {}).keys():
@@ -95,6 +173,12 @@ class SiteGenerator:
                 category.add_page(page)
         page.category = category
 
+    def build_page(self, page_data, parent_page):
+        page = self.page_builder.build(page_data, parent_page)
+        page.category_id = page_data.get('category')
+        self.categorize_page(page)
+
+        category = page.category
         if not page.template:
             if category and category['template']:
                 page.template = category['template']
@@ -108,63 +192,310 @@ class SiteGenerator:
         if path in self.props.get('blocked_dirs'):
             return {}
 
-        page_data = self.read_page(path)
         page = None
+        if self.page_objects is not None:
+            page = self.page_objects.get(path)
         children = {}
-        if page_data:
-            page = self.build_page(page_data, parent_page)
+        if page and page.parent is parent_page:
+            # unchanged since the last build
+            self.categorize_page(page)
+        else:
+            page_data = self.read_page(path)
+            page = None
+            if page_data:
+                page = self.build_page(page_data, parent_page)
+                if self.page_objects is not None:
+                    self.page_objects[path] = page
+        if page:
             # add page to ordered list of pages
             if not page.is_draft():
                 self.pagelist.insert(page)
+            if page.is_listable():
+                self.tag_index.add_page(page)
         for sub_page_path in self.read_subpages_list(path):
             child_info = self.read_page_tree(sub_page_path, page or parent_page)
             if child_info:
                 children.update(child_info)
 
+    def is_forbidden_dir(self, fullpath):
+        basedir = os.path.dirname(fullpath)
+        basename = os.path.basename(fullpath)
+        return bool(set((basedir, basename)).intersection(FORBIDDEN_DIRS))
+
     def read_subpages_list(self, path):
-        for filename in os.listdir(path or os.curdir):
-            fullpath = os.path.join(path, filename)
-            if not os.path.isdir(fullpath):
-                continue
-            basedir = os.path.dirname(fullpath)
-            basename = os.path.basename(fullpath)
-            if set((basedir, basename)).intersection(FORBIDDEN_DIRS):
-                continue
-            yield fullpath
+        for fullpath in self.index.subdirs(path):
+            if not self.is_forbidden_dir(fullpath):
+                yield fullpath
 
-    def write_html(self, page, env):
-        if 'nohtml' in page.props:
-            return
+    def templates_dir(self):
         templates_dir = self.props.get('templates_dir', TEMPLATES_DIR)
-        templates_dir = os.path.join(self.base_path, templates_dir)
-        filename = ".".join([page.template, TEMPLATES_EXT])
-        template_path = os.path.join(templates_dir, filename)
-        template = HTMLTemplate(page.template, template_path)
-        template.include_path = templates_dir
+        return os.path.join(self.base_path, templates_dir)
 
+    def html_path(self, page):
+        html_filename = self.props.get('html_filename', HTML_FILENAME)
+        return os.path.join(page.path, html_filename)
+
+    def template_path(self, page):
+        filename = ".".join([page.template, TEMPLATES_EXT])
+        return os.path.join(self.templates_dir(), filename)
+
+    def page_inputs(self, page):
+        '''Return the files a page output is generated from'''
+        data_file = self.props.get('data_file', DATA_FILE)
+        image_file = self.props.get('image_file', IMAGE_FILE)
+        inputs = [
+            os.path.join(self.base_path, CONFIG_FILE),
+            os.path.join(page.path, data_file),
+            self.template_path(page)
+        ]
+        # adding or removing one of these changes the inputs anyway
+        for filename in (image_file, THUMB_FILENAME):
+            if self.index.has_file(page.path, filename):
+                inputs.append(os.path.join(page.path, filename))
+        return inputs
+
+    def load_manifest(self, force=False):
+        cache_dir = self.props.get('cache_dir', CACHE_DIR)
+        path = os.path.join(self.base_path, cache_dir, MANIFEST_FILE)
+        manifest = BuildManifest(path)
+        if not force:
+            manifest.load()
+            self.page_data.load()
+            self.fragments.load()
+        return manifest
+
+    def save_page_data(self):
+        '''Save the parsed page files that are still in the site'''
+        def exists(path):
+            dirname, filename = os.path.split(path)
+            return self.index.has_file(dirname, filename)
+        self.page_data.save(keep=exists)
+
+    def prune_tree_cache(self):
+        '''Remove the saved trees of templates that were changed or
+        deleted, keeping the ones of the current template files'''
+        templates_dir = self.templates_dir()
+        templates = [(os.path.join(DATA_DIR, FEED_FILE), '')]
+        for dirpath, _, filenames in os.walk(templates_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                templates.append((path, templates_dir))
+        for path, include_path in templates:
+            try:
+                text = utils.read_file(path)
+            except (OSError, ValueError):
+                continue
+            self.tree_cache.keep(text, include_path, True)
+        self.tree_cache.prune()
+
+    def html_template(self, page):
+        template = HTMLTemplate(page.template, self.template_path(page))
+        template.include_path = self.templates_dir()
+        return template
+
+    def stream_html(self, page, env, write):
+        '''Pass the page HTML to write as it is rendered and return
+        the template files it used'''
+        template = self.html_template(page)
         try:
-            output = template.render(page, env)
+            template.stream(page, env, write)
         except TemplateError as error:
             raise TemplateError('{} at template {!r}'.format(error,
                                 template.path))
-        html_filename = self.props.get('html_filename', HTML_FILENAME)
-        html_path = os.path.join(page.path, html_filename)
-        utils.write_file(html_path, output)
+        return template.dependencies
 
-    def publish_page(self, page, env):
+    def write_html(self, page, env):
+        '''Write the page HTML as it is rendered and return
+        the template files it used'''
+        if 'nohtml' in page.props:
+            return set()
+        with utils.write_stream(self.html_path(page)) as fp:
+            return self.stream_html(page, env, fp.write)
+
+    def page_key(self, page, site_key):
+        '''Digest of the data used to render a page'''
+        build_data = [page[key] for key in BUILD_KEYS]
+        return cached_digest(page, 'key', [site_key, page.template,
+                                           page.styles, page.scripts,
+                                           page.props, page_digest(page),
+                                           build_data])
+
+    def site_key(self, env):
+        '''Digest of the site data every page is rendered with'''
+        return hash_data([self.props, env['categories']])
+
+    def tags_digest(self):
+        '''Digest of the tag index, computed once for each build'''
+        if self.tags_key is None:
+            self.tags_key = hash_data([
+                [tag.id, tag['name'], tag['url'],
+                 [listed_digest(page) for page in tag.pagelist]]
+                for tag in self.tag_index.tags()])
+        return self.tags_key
+
+    def templates_digest(self):
+        '''Digest of the template files, kept until one of them changes'''
+        if self.templates_key is None:
+            templates = []
+            for dirpath, _, filenames in os.walk(self.templates_dir()):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    templates.append([path, file_stat(path)])
+            self.templates_key = hash_data(sorted(templates))
+        return self.templates_key
+
+    def fragments_key(self, env, listing):
+        '''Digest of the data cached fragments may have read'''
+        return hash_data([self.site_key(env), listing.digests,
+                          self.tags_digest(), self.templates_digest()])
+
+    def shared_checks(self, listing):
+        '''Functions checking if the build-wide data read by
+        the last render of a page is unchanged'''
+        return {
+            'listing': listing.check,
+            'tags': lambda digest: digest == self.tags_digest()
+        }
+
+    def outdated_pages(self, pages, env, manifest, listing, forced=None):
+        '''Return (page, key) pairs of the pages that must be rendered,
+        including the ones selected by forced even if up to date'''
+        outdated = []
+        shared = self.shared_checks(listing)
+        site_key = self.site_key(env)
+        for page in pages:
+            key = self.page_key(page, site_key)
+            inputs = self.page_inputs(page)
+            html_path = self.html_path(page)
+            if forced and forced(page):
+                outdated.append((page, key))
+            elif not manifest.is_fresh(page.path, key, inputs,
+                                       html_path, shared):
+                outdated.append((page, key))
+        return outdated
+
+    def render_with(self, page, env, render):
+        '''Call render with the page and an env remembering how the
+        page listing and the tags are read. Return the files it used,
+        how the page listing was read and if the tags were'''
+        listing = PageListing(env['pages'])
+        tags = TagUsage(env['tags'])
         try:
-            self.write_html(page, env)
+            dependencies = render(page,
+                Scope(env, {'pages': listing, 'tags': tags}))
         except FileNotFoundError as error:
             raise FileNotFoundError('{} at page {!r}'.format(error, page.path))
+        return dependencies, listing.usage(), tags.read
 
-    def publish_feeds(self):
-        env = { 'site': self.props, 'template_cache': {}}
-        file_path = self.write_feed(env, self.pagelist, 'rss')
-        print("Generated RSS {!r}.".format(file_path))
+    def render_page(self, page, env):
+        '''Return the page HTML and the result of publish_page'''
+        output = []
+        def render(page, env):
+            return self.stream_html(page, env, output.append)
+        result = self.render_with(page, env, render)
+        return ''.join(output), result
 
-    def write_feed(self, env, pagelist, name):
-        if not len(pagelist):
+    def publish_page(self, page, env):
+        '''Write the page HTML, return the files it used, how the
+        page listing was read and if the tags were'''
+        return self.render_with(page, env, self.write_html)
+
+    def record_page(self, page, key, manifest, listing, result, output_path):
+        dependencies, listing_usage, tags_read = result
+        inputs = sorted(set(dependencies).union(self.page_inputs(page)))
+        # pages not listing other pages don't depend on them
+        shared = {}
+        if listing_usage:
+            shared['listing'] = listing.record(listing_usage)
+        if tags_read:
+            shared['tags'] = self.tags_digest()
+        manifest.record(page.path, key, inputs, output_path, shared)
+
+    def tag_dir(self):
+        return os.path.join(self.base_path,
+                            self.props.get('tag_dir', TAG_DIR))
+
+    def build_tags(self):
+        '''Set the ids and URLs of the tag listing pages'''
+        self.tag_index.assign_ids()
+        for tag in self.tag_index.tags():
+            path = os.path.join(self.tag_dir(), tag.id)
+            tag['url'] = self.page_builder.build_url_from_path(path)
+
+    def tag_template(self):
+        return self.props.get('tag_template',
+                              self.props.get('default_template'))
+
+    def tag_page(self, tag):
+        '''Return the page listing the pages of a tag'''
+        page = Page()
+        page.path = os.path.join(self.tag_dir(), tag.id)
+        page.template = self.tag_template()
+        page.data = PageData({
+            'title': tag['name'],
+            'url': tag['url'],
+            'tag': tag.id,
+            'date': tag.pagelist[-1]['date'],
+            'content': ''
+        })
+        return page
+
+    def publish_tags(self, env, manifest=None, force=False):
+        '''Write a page listing the pages of each tag'''
+        if not self.tag_template():
             return
+        site_key = self.site_key(env)
+        config_path = os.path.join(self.base_path, CONFIG_FILE)
+        if manifest:
+            self.remove_tag_pages(manifest)
+        for tag in self.tag_index.tags():
+            page = self.tag_page(tag)
+            # tag pages may read the whole index
+            key = hash_data([site_key, page.template, self.tags_digest()])
+            inputs = [config_path, self.template_path(page)]
+            html_path = self.html_path(page)
+            if (manifest and not force
+                    and manifest.is_fresh(page.path, key, inputs, html_path)):
+                continue
+            os.makedirs(page.path, exist_ok=True)
+            tag_env = dict(env, pages=list(tag.pagelist), tag=tag.get_dict())
+            try:
+                dependencies = self.write_html(page, tag_env)
+            except FileNotFoundError as error:
+                raise FileNotFoundError('{} at tag {!r}'.format(error,
+                                                                tag.id))
+            if manifest:
+                inputs = sorted(set(dependencies).union(inputs))
+                manifest.record(page.path, key, inputs, html_path)
+            print('Generated tag page {!r}.'.format(page.path))
+
+    def remove_tag_pages(self, manifest):
+        '''Delete the pages written by the last build for tags
+        no longer used by any page'''
+        tag_dir = self.tag_dir()
+        for name, output_path in manifest.outputs():
+            if os.path.dirname(name) != tag_dir:
+                continue
+            if os.path.basename(name) in self.tag_index:
+                continue
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            if os.path.isdir(name) and not os.listdir(name):
+                os.rmdir(name)
+            print('Removed tag page {!r}.'.format(name))
+
+    def publish_feeds(self, manifest=None, force=False):
+        env = {'site': self.props, 'templates': self.templates,
+               'include_cache': self.include_cache,
+               'fragment_cache': self.fragments}
+        file_path = self.write_feed(env, self.pagelist, 'rss', manifest,
+                                    force)
+        if file_path:
+            print("Generated RSS {!r}.".format(file_path))
+
+    def prepare_feed(self, env, pagelist, name):
+        '''Set the feed data in env, return the feed template,
+        file path and the key of the data it is rendered with'''
         template = Template(FEED_FILE, os.path.join(DATA_DIR, FEED_FILE))
         try:
             feed_num = int(self.props.get('feed_num', FEED_NUM))
@@ -173,9 +504,6 @@ class SiteGenerator:
 
         dirname = self.props.get('feed_dir', FEED_DIR)
         basepath = os.path.join(self.base_path, dirname)
-        if not os.path.exists(basepath):
-            os.makedirs(basepath)
-
         pagelist = [p for p in pagelist if p.is_feed_enabled()]
         pagelist.reverse()
         base_url = self.props['base_url']
@@ -186,35 +514,208 @@ class SiteGenerator:
             'build_date': datetime.today()
         }
         rss_file = os.path.join(basepath, filename)
-        utils.write_file(rss_file, template.render(env))
+        # the build date alone doesn't make a feed outdated
+        key = hash_data([self.props, env['feed']['link'],
+                         [[page_digest(page),
+                           [page[name] for name in BUILD_KEYS]]
+                          for page in env['pages']]])
+        return template, rss_file, key
+
+    def write_feed(self, env, pagelist, name, manifest=None, force=False):
+        if not len(pagelist):
+            return
+        template, rss_file, key = self.prepare_feed(env, pagelist, name)
+        inputs = [os.path.join(self.base_path, CONFIG_FILE), template.path]
+        if (manifest and not force
+                and manifest.is_fresh(rss_file, key, inputs, rss_file)):
+            return
+        basepath = os.path.dirname(rss_file)
+        if not os.path.exists(basepath):
+            os.makedirs(basepath)
+        with utils.write_stream(rss_file) as fp:
+            template.stream(env, fp.write)
+        if manifest:
+            manifest.record(rss_file, key, inputs, rss_file)
         return rss_file
 
 
+def page_digest(page):
+    '''Return the digest of the data a page was built with,
+    computed once for each page object'''
+    if page.digest is None:
+        excluded = BUILD_KEYS
+        if page.default_date:
+            excluded += DATE_KEYS
+        page_data = {k: v for k, v in page.data.items()
+                     if k not in excluded}
+        body = getattr(page.data, 'body', None)
+        if body:
+            # the content is not read, its digests stand for it
+            page_data['content'], page_data['excerpt'] = body.digests
+        page.digest = hash_data(page_data)
+    return page.digest
+
+
+def cached_digest(page, name, data):
+    '''Return the digest of data, reusing the one last computed
+    under name for the page if the data is the same'''
+    cached = page.digests.get(name)
+    if cached is None or cached[0] != data:
+        cached = page.digests[name] = (data, hash_data(data))
+    return cached[1]
+
+
+def listed_digest(page):
+    '''Digest of the data of a page seen by the pages listing it,
+    including the content, since listings may print it'''
+    build_data = [page[key] for key in BUILD_KEYS]
+    return cached_digest(page, 'listed', [page_digest(page), build_data])
+
+
+class ListingDigest:
+    '''Digests of the parts of the page listing read by renders'''
+    def __init__(self, pages):
+        self.digests = [listed_digest(page) for page in pages]
+        self.cache = {}
+
+    def digest(self, usage):
+        front, back, sized = usage
+        key = (front, back, sized)
+        if key not in self.cache:
+            count = len(self.digests)
+            parts = self.digests[:front]
+            if back:
+                parts = parts + self.digests[max(count - back, 0):]
+            self.cache[key] = hash_data([count if sized else None, parts])
+        return self.cache[key]
+
+    def check(self, recorded):
+        '''Check if the part of the listing read last time is unchanged'''
+        return self.digest(recorded[:3]) == recorded[3]
+
+    def record(self, usage):
+        return usage + [self.digest(usage)]
+
+
 class Site:
-    def __init__(self, props):
+    def __init__(self, props, resident=False):
         self.props = props
-
-    def generate(self, path):
+        self.resident = resident
+        self.skipped = 0
+        self.generated = []
+        self.jobs = 1
+        self.threads = 1
+        self.generator = None
+        self.manifest = None
+
+    def data_path(self):
+        return '{}/data'.format(self.props['base_path'])
+
+    def setup(self, path, base_url=None):
+        '''Create a generator for the site at path'''
         self.props['base_path'] = path.rstrip(os.path.sep)
-        self.props['base_url'] = os.environ.get('URL', BASE_URL)
+        self.props['base_url'] = base_url or os.environ.get('URL', BASE_URL)
+        self.generator = SiteGenerator(self.props, self.resident)
+        self.generator.scan(self.data_path(), max(self.jobs, self.threads))
+
+    def generate(self, path, force=False, jobs=1, threads=1):
+        self.jobs = jobs
+        self.threads = threads
+        self.setup(path)
+        self.manifest = self.generator.load_manifest(force)
+        pages = self.build()
+        self.save()
+        return pages
 
-        generator = SiteGenerator(self.props)
+    def save(self):
+        '''Keep what was learned by this build for the next ones'''
+        self.manifest.save()
+        self.generator.save_page_data()
+        self.generator.fragments.save()
+        self.generator.prune_tree_cache()
+
+    def invalidate(self, paths):
+        '''Forget what was read from changed files, return
+        the ones that are build inputs'''
+        generator = self.generator
+        paths = [path for path in paths if not generator.is_output(path)]
+        if self.props['base_path'] in paths:
+            # the changes are unknown, so read everything again
+            self.setup(self.props['base_path'], self.props['base_url'])
+            self.generator.page_data.load()
+            self.manifest.invalidate(list(self.manifest.verified))
+        elif paths:
+            generator.invalidate(paths)
+            self.manifest.invalidate(paths)
+        return paths
+
+    def update(self, paths):
+        '''Regenerate the outputs depending on changed files,
+        return None if none of them is a build input'''
+        if not self.invalidate(paths):
+            return None
+        return self.build()
+
+    def read(self):
+        '''Read the pages, return them and the environment
+        their templates are rendered with'''
+        generator = self.generator
+        generator.reset()
         category_list = generator.build_categories()
 
-        generator.read_page_tree(f'{path}/data')
+        generator.read_page_tree(self.data_path())
         for cat in generator.category_list:
             cat.paginate()
+        generator.build_tags()
         pages = generator.pagelist
         env = {
             'pages': [p for p in pages if p.is_listable()],
             'site': self.props,
             'categories': category_list,
-            'template_cache': {}
+            'tags': generator.tag_index,
+            'templates': generator.templates,
+            'include_cache': generator.include_cache,
+            'fragment_cache': generator.fragments
         }
+        return pages, env
 
-        for page in pages:
-            env['page'] = page
-            generator.publish_page(page, env)
+    def rebuild_category(self, category_id):
+        '''Render the pages of a category again, even if up to date'''
+        return self.build(lambda page: page.category_id == category_id)
+
+    def publish_feeds(self):
+        '''Read the pages and write the feeds again'''
+        self.read()
+        self.generator.publish_feeds(self.manifest, force=True)
+        self.manifest.commit()
+
+    def build(self, forced=None):
+        generator = self.generator
+        manifest = self.manifest
+        jobs, threads = self.jobs, self.threads
+        pages, env = self.read()
+
+        listing = ListingDigest(env['pages'])
+        generator.fragments.start(generator.fragments_key(env, listing))
+        outdated = generator.outdated_pages(pages, env, manifest, listing,
+                                            forced)
+        self.skipped = len(pages) - len(outdated)
+        outdated_pages = [page for page, _ in outdated]
+        self.generated = [page.path for page in outdated_pages]
+        if threads > 1:
+            results = parallel.publish_pages_threaded(generator,
+                outdated_pages, env, threads)
+        elif jobs > 1:
+            results = parallel.publish_pages(generator, outdated_pages,
+                                             env, jobs)
+        else:
+            results = (generator.publish_page(page, env)
+                       for page in outdated_pages)
+        for (page, key), result in zip(outdated, results):
+            generator.record_page(page, key, manifest, listing, result,
+                                  generator.html_path(page))
             print('Generated HTML {!r}.'.format(page.path))
-        generator.publish_feeds()
+        generator.publish_tags(env, manifest)
+        generator.publish_feeds(manifest)
+        manifest.rotate()
         return pages
@@ -0,0 +1,277 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import os
+import time
+import pickle
+import marshal
+import hashlib
+import threading
+import importlib.util
+
+
+CACHE_VERSION = '6'
+CACHE_EXT = 'tree'
+FRAGMENT_CACHE_VERSION = 2
+# seconds, file times may be rounded down as much on some file systems
+FILE_TIME_RESOLUTION = 2
+
+
+def file_digest(path):
+    try:
+        with open(path, 'rb') as fp:
+            return hashlib.sha1(fp.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class TreeCache:
+    '''Parsed templates saved in a directory, reused while the text
+    of the template and of the files it uses are unchanged'''
+    def __init__(self, path):
+        self.path = path
+        # entries are touched when used, also by worker processes,
+        # so the ones older than this were not used since
+        self.start = time.time() - FILE_TIME_RESOLUTION
+
+    def entry_path(self, text, include_path, compiled):
+        # trees hold code objects, only valid for this Python version
+        data = '\0'.join([CACHE_VERSION, str(importlib.util.MAGIC_NUMBER),
+                          include_path, str(compiled), text])
+        key = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '{}.{}'.format(key, CACHE_EXT))
+
+    def load(self, text, include_path='', compiled=False):
+        '''Return the saved tree of a template, or None'''
+        path = self.entry_path(text, include_path, compiled)
+        try:
+            with open(path, 'rb') as fp:
+                files = pickle.load(fp)
+                for file_path, digest in files.items():
+                    if file_digest(file_path) != digest:
+                        return None
+                tree = pickle.load(fp)
+            os.utime(path)
+            return tree
+        except Exception:
+            # missing or damaged entries are just parsed again
+            return None
+
+    def save(self, text, include_path, compiled, tree):
+        '''Save a tree along with the digests of the files
+        it was parsed from'''
+        files = {path: file_digest(path)
+                 for path in tree.parser.dependencies}
+        path = self.entry_path(text, include_path, compiled)
+        temp_path = '{}.{}'.format(path, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(temp_path, 'wb') as fp:
+                pickle.dump(files, fp, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(tree, fp, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except (OSError, pickle.PicklingError):
+            # templates still render without a cache
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def keep(self, text, include_path='', compiled=False):
+        '''Mark the entry of a template as used without loading it'''
+        try:
+            os.utime(self.entry_path(text, include_path, compiled))
+        except OSError:
+            pass
+
+    def prune(self):
+        '''Remove the entries not used since the cache was created,
+        left by templates that were changed or deleted'''
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.' + CACHE_EXT):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                if os.stat(path).st_mtime < self.start:
+                    os.remove(path)
+            except OSError:
+                # removed by another build
+                pass
+
+
+class IncludeCache:
+    '''Files read by include commands and trees parsed by parse
+    commands, shared by the renders of a build'''
+    def __init__(self):
+        # file path: (file state, content)
+        self.files = {}
+        # (include path, file path): (file states, tree, dependencies)
+        self.trees = {}
+        # lookups answered from the cache, files read and trees parsed
+        self.hits = 0
+        self.reads = 0
+        self.parses = 0
+        # may be shared by render threads
+        self.lock = threading.Lock()
+
+    def read(self, path):
+        '''Return the content of a file, read only the first time'''
+        with self.lock:
+            entry = self.files.get(path)
+            if entry:
+                self.hits += 1
+                return entry[1]
+            self.reads += 1
+        state = file_state(path)
+        with open(path, 'r') as fp:
+            content = fp.read()
+        with self.lock:
+            self.files[path] = (state, content)
+        return content
+
+    def get_tree(self, include_path, path):
+        '''Return the tree parsed from a file and the files
+        it depends on, or None'''
+        with self.lock:
+            entry = self.trees.get((include_path, path))
+            if entry:
+                self.hits += 1
+                return entry[1:]
+
+    def add_tree(self, include_path, path, tree, dependencies):
+        states = {name: file_state(name) for name in dependencies}
+        with self.lock:
+            self.parses += 1
+            self.trees[(include_path, path)] = (states, tree, dependencies)
+
+    def refresh(self):
+        '''Forget the files changed on disk and the trees
+        parsed from them'''
+        with self.lock:
+            for path, entry in list(self.files.items()):
+                if file_state(path) != entry[0]:
+                    del self.files[path]
+            for key, entry in list(self.trees.items()):
+                states = entry[0]
+                if any(file_state(path) != state
+                       for path, state in states.items()):
+                    del self.trees[key]
+
+    def __reduce__(self):
+        # the cached files are not sent to other processes
+        return (IncludeCache, ())
+
+
+class FragmentCache:
+    '''Outputs of cache blocks by key, along with how they read the
+    collections of the context. They are kept for a build, or while
+    the key of the builds is the same if the cache is persistent'''
+    def __init__(self, path=None, persistent=False):
+        self.path = path
+        self.persistent = persistent
+        self.key = None
+        # cache key: [output, usage of each collection]
+        self.fragments = {}
+        self.added = {}
+        self.hits = 0
+        self.misses = 0
+        # may be shared by render threads
+        self.lock = threading.Lock()
+
+    def start(self, key):
+        '''Begin a build, keeping the fragments of the previous
+        ones only if persistent and key is the same'''
+        with self.lock:
+            if not self.persistent or key != self.key:
+                self.fragments = {}
+            self.key = key
+            self.added = {}
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.fragments.get(key)
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def set(self, key, output, usage):
+        with self.lock:
+            self.fragments[key] = self.added[key] = [output, usage]
+
+    def take_updates(self):
+        '''Return and forget the fragments added and the
+        counts since the last call'''
+        with self.lock:
+            updates = (self.added, self.hits, self.misses)
+            self.added = {}
+            self.hits = 0
+            self.misses = 0
+        return updates
+
+    def merge(self, updates):
+        '''Add what another copy of the cache did'''
+        added, hits, misses = updates
+        with self.lock:
+            self.fragments.update(added)
+            self.added.update(added)
+            self.hits += hits
+            self.misses += misses
+
+    def load(self):
+        if not (self.path and self.persistent):
+            return
+        try:
+            with open(self.path, 'rb') as fp:
+                data = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if not isinstance(data, dict):
+            return
+        if data.get('version') != FRAGMENT_CACHE_VERSION:
+            return
+        self.key = data.get('key')
+        self.fragments = data.get('fragments', {})
+
+    def save(self):
+        if not (self.path and self.persistent and self.added):
+            return
+        temp_path = '{}.{}'.format(self.path, os.getpid())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(temp_path, 'wb') as fp:
+            marshal.dump({'version': FRAGMENT_CACHE_VERSION, 'key': self.key,
+                          'fragments': self.fragments}, fp)
+        os.replace(temp_path, self.path)
+        self.added = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
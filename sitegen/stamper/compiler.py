@@ -0,0 +1,338 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import marshal
+import operator
+import contextlib
+
+from . import tree
+from .scope import frame
+from .exceptions import BreakStatement, FunctionReturn, RenderError
+
+
+# operators written inline, the others are called
+INLINE_OPERATORS = {
+    operator.mul: '*',
+    operator.floordiv: '//',
+    operator.mod: '%',
+    operator.add: '+',
+    operator.sub: '-',
+    operator.gt: '>',
+    operator.ge: '>=',
+    operator.lt: '<',
+    operator.le: '<=',
+    operator.eq: '==',
+    operator.ne: '!='
+}
+
+
+class CompiledFunction(tree.Function):
+    '''A template function running the compiled body of its node'''
+    def __init__(self, node, body, context):
+        super().__init__(node, context)
+        self.body = body
+
+    def call(self, args):
+        return self.node.call(self.context, args, self.body)
+
+
+def define_function(node, body, context):
+    # same binding as FunctionNode.render
+    function = CompiledFunction(node, body, None)
+    context[node.value] = function
+    function.context = context.copy()
+
+
+class CompiledTree:
+    '''A stamper tree translated to a Python function, rendering
+    the same output as the tree itself'''
+    def __init__(self, root, constants, code, source):
+        self.root = root
+        self.constants = constants
+        self.code = code
+        self.source = source
+        namespace = dict(constants)
+        exec(code, namespace)
+        self.function = namespace['render']
+
+    @property
+    def parser(self):
+        return self.root.parser
+
+    def render(self, context):
+        output = []
+        self.root.run(self.function, frame(context), output.append)
+        return ''.join(output)
+
+    def stream(self, context, write):
+        self.root.run(self.function, frame(context), write)
+
+    def __getstate__(self):
+        # code objects are pickled with marshal, the constants
+        # are nodes of the tree and helpers of this module
+        return (self.root, self.constants, marshal.dumps(self.code),
+                self.source)
+
+    def __setstate__(self, state):
+        root, constants, code, source = state
+        self.__init__(root, constants, marshal.loads(code), source)
+
+
+class Compiler:
+    '''Translate a stamper tree to the source of a Python module'''
+    def __init__(self):
+        self.namespace = {
+            '_neg': operator.neg,
+            '_define': define_function,
+            '_item': tree.get_item,
+            '_Break': BreakStatement,
+            '_Return': FunctionReturn,
+            'RenderError': RenderError
+        }
+        self.lines = []
+        self.level = 0
+        self.temp_count = 0
+        self.function_count = 0
+        # state of the block being compiled
+        self.context = 'c0'
+        self.write = '_w'
+        self.in_loop = False
+        self.in_function = False
+
+    def constant(self, value):
+        name = '_k{}'.format(len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def temp(self):
+        self.temp_count += 1
+        return 't{}'.format(self.temp_count)
+
+    def line(self, text):
+        self.lines.append('    ' * self.level + text)
+
+    @contextlib.contextmanager
+    def indent(self):
+        self.level += 1
+        start = len(self.lines)
+        yield
+        if len(self.lines) == start:
+            self.line('pass')
+        self.level -= 1
+
+    @contextlib.contextmanager
+    def scope(self, **state):
+        saved = {name: getattr(self, name) for name in state}
+        for name, value in state.items():
+            setattr(self, name, value)
+        yield
+        for name, value in saved.items():
+            setattr(self, name, value)
+
+    def compile(self, root):
+        self.line('def render(c0, _w):')
+        with self.indent():
+            self.block(root.children)
+        source = '\n'.join(self.lines) + '\n'
+        code = compile(source, '<stamper>', 'exec')
+        return CompiledTree(root, self.namespace, code, source)
+
+    def block(self, children):
+        for child in children:
+            self.statement(child)
+
+    def statement(self, node):
+        method = getattr(self, 'stmt_' + type(node).__name__, None)
+        if method:
+            method(node)
+        else:
+            # rendered by the node itself
+            name = self.constant(node)
+            self.line('{}(str({}.render({})))'.format(self.write, name,
+                                                      self.context))
+
+    def stmt_Block(self, node):
+        self.block(node.children)
+
+    def stmt_Text(self, node):
+        if node.value:
+            self.line('{}({!r})'.format(self.write, node.value))
+
+    def stmt_PrintCommand(self, node):
+        value = self.expression(node.value)
+        name = self.constant(node)
+        self.line('{0}({1} if {1}.__class__ is str else {2}.format({1}))'
+                  .format(self.write, value, name))
+
+    def stmt_FunctionCall(self, node):
+        value = self.expression(node)
+        self.line('{}(str({}))'.format(self.write, value))
+
+    def stmt_Assignment(self, node):
+        value = self.expression(node.rvalue)
+        self.line('{}[{!r}] = {}'.format(self.context, node.value, value))
+
+    def stmt_Condition(self, node):
+        value = self.expression(node.value)
+        self.line('if {}:'.format(value))
+        with self.indent():
+            self.block(node.true_block)
+        if node.false_block:
+            self.line('else:')
+            with self.indent():
+                self.block(node.false_block)
+
+    def loop_body(self, children):
+        # breaks raised by function calls end the loop too
+        self.line('try:')
+        with self.indent(), self.scope(in_loop=True):
+            self.block(children)
+        self.line('except _Break as _b:')
+        with self.indent():
+            self.line('{}(_b.partial_output)'.format(self.write))
+            self.line('break')
+
+    def stmt_WhileLoop(self, node):
+        self.line('while True:')
+        with self.indent():
+            value = self.expression(node.value)
+            self.line('if not {}:'.format(value))
+            with self.indent():
+                self.line('break')
+            self.loop_body(node.children)
+
+    def stmt_ListNode(self, node):
+        name = self.constant(node)
+        context = self.temp()
+        self.line('for {} in {}.iterate({}):'.format(context, name,
+                                                    self.context))
+        with self.indent(), self.scope(context=context):
+            self.loop_body(node.children)
+
+    def stmt_BreakCommand(self, node):
+        if self.in_loop:
+            self.line('break')
+        else:
+            name = self.constant(node)
+            self.line('raise _Break(token={}.token)'.format(name))
+
+    def stmt_ReturnCommand(self, node):
+        value = self.expression(node.value)
+        if self.in_function:
+            self.line('return {}'.format(value))
+        else:
+            name = self.constant(node)
+            self.line('raise _Return({}.token, {})'.format(name, value))
+
+    def stmt_FunctionNode(self, node):
+        self.function_count += 1
+        body = '_f{}'.format(self.function_count)
+        lines, self.lines = self.lines, []
+        level, self.level = self.level, 0
+        self.line('def {}(c0):'.format(body))
+        with self.indent():
+            self.line('_o = []')
+            self.line('_w = _o.append')
+            self.line('try:')
+            with self.indent(), self.scope(context='c0', write='_w',
+                                           in_loop=False, in_function=True):
+                self.block(node.children)
+            self.line('except _Break as _b:')
+            with self.indent():
+                self.line("_b.partial_output = ''.join(_o) + _b.partial_output")
+                self.line('raise')
+            self.line("return ''.join(_o)")
+        # function bodies are defined before the render function
+        lines[:0] = self.lines
+        self.lines, self.level = lines, level
+        name = self.constant(node)
+        self.line('_define({}, {}, {})'.format(name, body, self.context))
+
+    def expression(self, node):
+        '''Write the statements computing the value of an expression
+        and return a Python expression holding it'''
+        if isinstance(node, tree.Number):
+            return repr(int(node.value))
+        if isinstance(node, (tree.String, tree.Constant)):
+            return repr(node.value)
+        if isinstance(node, tree.Boolean):
+            return repr({'true': True, 'false': False}[node.value])
+        method = getattr(self, 'expr_' + type(node).__name__, None)
+        temp = self.temp()
+        if method:
+            method(node, temp)
+        else:
+            name = self.constant(node)
+            self.line('{} = {}.render({})'.format(temp, name, self.context))
+        return temp
+
+    def lookup(self, path, temp):
+        self.line('try:')
+        with self.indent():
+            self.line('{} = {}[{!r}]'.format(temp, self.context, path[0]))
+        self.line('except KeyError:')
+        with self.indent():
+            self.line("{} = ''".format(temp))
+        for part in path[1:]:
+            self.line("{0} = ({0}[{1!r}] if {1!r} in {0} else '') "
+                      "if {0}.__class__ is dict else _item({0}, {1!r})"
+                      .format(temp, part))
+
+    def expr_Variable(self, node, temp):
+        self.lookup(node.path, temp)
+
+    def expr_UnaryMinus(self, node, temp):
+        values = [self.expression(child) for child in node.children]
+        parts = ' + '.join('str({})'.format(value) for value in values)
+        self.line('{} = _neg({})'.format(temp, parts or "''"))
+
+    def expr_Operation(self, node, temp):
+        first = self.expression(node.children[0])
+        self.line('{} = {}'.format(temp, first))
+        name = self.constant(node)
+        self.line('try:')
+        with self.indent():
+            if len(node.children) > 1:
+                symbol = INLINE_OPERATORS.get(node.value)
+                for child in node.children[1:]:
+                    value = self.expression(child)
+                    if symbol:
+                        self.line('{0} = {0} {1} {2}'.format(temp, symbol,
+                                                             value))
+                    else:
+                        self.line('{0} = {1}.value({0}, {2})'.format(
+                            temp, name, value))
+            else:
+                self.line('{0} = {1}.value({0})'.format(temp, name))
+        self.line('except ZeroDivisionError:')
+        with self.indent():
+            self.line("{}.error(RenderError, 'Division by zero')".format(name))
+        self.line('except TypeError:')
+        with self.indent():
+            self.line("{}.error(RenderError, "
+                      "'Wrong types in operation')".format(name))
+
+    def expr_FunctionCall(self, node, temp):
+        name = self.constant(node)
+        self.lookup(node.path, temp)
+        self.line('if not {}:'.format(temp))
+        with self.indent():
+            msg = 'Function {!r} not defined'.format(node.value)
+            self.line('{}.error(RenderError, {!r})'.format(name, msg))
+        args = [self.expression(arg) for arg in node.args]
+        self.line('{0} = {0}.call([{1}])'.format(temp, ', '.join(args)))
+
+
+def compile_tree(root):
+    '''Return a compiled version of a parsed template'''
+    return Compiler().compile(root)
@@ -37,3 +37,7 @@ class NodeError(Exception):
 
 class FileNotFoundError(NodeError):
     pass
+
+
+class RenderError(NodeError):
+    pass
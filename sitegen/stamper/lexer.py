@@ -14,6 +14,7 @@ License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
 import sys
 import operator
 import re
+from bisect import bisect_right
 
 NUMBER = 'number'
 STRING = 'string'
@@ -63,6 +64,7 @@ USE = 'use'
 REGION = 'region'
 LIMIT = 'limit'
 BREAK = 'break'
+CACHE = 'cache'
 
 BOOLEAN_VALUES = ['true', 'false']
 
@@ -89,6 +91,16 @@ TAG_MAP = {
     TAG_COMMENT_CLOSE: CLOSE_COMMENT
 }
 
+# named so that parsed trees can be pickled
+def bool_and(x, y):
+    return x and y
+
+def bool_or(x, y):
+    return x or y
+
+def bool_not(x):
+    return not x
+
 OPMAP = {
     MUL: operator.mul,
     DIV: operator.floordiv,
@@ -101,9 +113,9 @@ OPMAP = {
     LE: operator.le,
     EQUAL: operator.eq,
     DIFF: operator.ne,
-    BOOL_AND: lambda x,y: x and y,
-    BOOL_OR: lambda x,y: x or y,
-    BOOL_NOT: lambda x: not x
+    BOOL_AND: bool_and,
+    BOOL_OR: bool_or,
+    BOOL_NOT: bool_not
 }
 
 def build_token_regex():
@@ -117,40 +129,41 @@ def build_token_regex():
     KEYWORDS = r'\b|\b'.join([IF, ELSE, WHILE, AS,
         FUNCTION, RETURN, PRINT, INCLUDE, BOOL_NOT,
         BOOL_AND, BOOL_OR, PARSE, END, LIST, REVLIST,
-        USE, REGION, LIMIT, BREAK])
+        USE, REGION, LIMIT, BREAK, CACHE])
 
     TAGS = []
     for key, tag in TAG_MAP.items():
         TAGS.append('(?P<{}>{})'.format(key, re.escape(tag)))
 
-    # organize by matching priority
-    regex = '|'.join([
+    # organize by matching priority, skipping the whitespace before
+    regex = r'\s*(?:{})'.format('|'.join([
         '|'.join(TAGS),
         r'(?P<{}>\b{}\b)'.format(KEYWORD, KEYWORDS),
         r'(?P<{}>\b[a-zA-Z_]\w*(\.[a-zA-Z_]\w*)*\b)'.format(IDENTIFIER),
         r'(?P<{}>\".*?\"|\'.*?\')'.format(STRING),
         r'(?P<{}>[-+]?[0-9]+)'.format(NUMBER),
         r'(?P<{}>{})'.format(SYMBOL, SYMBOLS),
-        r'(?P<{}>\s+)'.format(WHITESPACE),
         r'(?P<unknow>.)'
-    ])
+    ]))
     return re.compile(regex, re.DOTALL)
 
-def build_tag_regex():
-    base = '(?P<{}>{}.*?{})'
-    e = re.escape
-    tag_re = '|'.join([
-        base.format(TAG_VAR_OPEN, e(OPEN_VAR), e(CLOSE_VAR)),
-        base.format(TAG_CMD_OPEN, e(OPEN_CMD), e(CLOSE_CMD)),
-        base.format(TAG_COMMENT_OPEN, e(OPEN_COMMENT), e(CLOSE_COMMENT))
-    ])
-    return re.compile(tag_re, re.DOTALL)
-
-TAG_REGEX = build_tag_regex()
 TOKEN_REGEX = build_token_regex()
 
+# tags by their opening symbol, closed by the first closing symbol
+TAG_OPEN_REGEX = re.compile('|'.join(re.escape(tag) for tag in (
+    OPEN_VAR, OPEN_CMD, OPEN_COMMENT)))
+TAG_CLOSE = {
+    OPEN_VAR: CLOSE_VAR,
+    OPEN_CMD: CLOSE_CMD,
+    OPEN_COMMENT: CLOSE_COMMENT
+}
+# matched inside tags but not passed to the parser
+SKIPPED = frozenset([TAG_CMD_OPEN, TAG_CMD_CLOSE])
+
 
 class Token():
+    __slots__ = ('type', 'value', 'column')
+
     def __init__(self, type, value, column):
         self.value = value
         self.type = type
@@ -175,6 +188,26 @@ class Token():
         return '{} [{}] - {}'.format(self.type, self.value, self.column)
 
 
+class LineTable:
+    '''Line and column of the offsets of a text, searched in the list
+    of offsets where each line starts, built on the first search'''
+    def __init__(self, text):
+        self.text = text
+        self.starts = None
+
+    def position(self, index):
+        if self.starts is None:
+            self.starts = [0] + [match.end()
+                                 for match in re.finditer('\n', self.text)]
+        line = bisect_right(self.starts, index)
+        return (line, index - self.starts[line - 1] + 1)
+
+    def __getstate__(self):
+        # the line starts are enough without the text
+        self.position(0)
+        return {'text': None, 'starts': self.starts}
+
+
 class Lexer:
     def __init__(self):
         self.tokens = []
@@ -182,28 +215,39 @@ class Lexer:
     def make_token(self, type, value, index_in_tpl):
         self.tokens.append(Token(type, value, index_in_tpl))
 
-    def extract_tokens(self, text, tag_matched):
-        offset = tag_matched.start()
-        for match in TOKEN_REGEX.finditer(text):
+    def extract_tokens(self, template, start, end):
+        '''Add the tokens of the tag between start and end'''
+        tokens = self.tokens
+        for match in TOKEN_REGEX.finditer(template, start, end):
             # ignore these tokens, emit only the VAR type
-            if match.lastgroup in (WHITESPACE, TAG_CMD_OPEN, TAG_CMD_CLOSE):
+            group = match.lastgroup
+            if group in SKIPPED:
                 continue
-            value = text[match.start(): match.end()]
-            if match.lastgroup == STRING:
+            value = match.group(group)
+            if group == STRING:
                 value = value[1:-1]  # remove string quotes
-            index = match.start() + offset
-            self.make_token(match.lastgroup, value, index)
+            tokens.append(Token(group, value, match.start(group)))
 
     def tokenize(self, template):
+        '''Return the tokens of a template, reading it once'''
         index = 0
-        for match in TAG_REGEX.finditer(template):
+        search = TAG_OPEN_REGEX.search
+        match = search(template)
+        while match:
             start = match.start()
-            end = match.end()
-            if template[index:start]:
+            symbol = match.group()
+            end = template.find(TAG_CLOSE[symbol], start + 2)
+            if end < 0:
+                # not a tag, read as text
+                match = search(template, start + 1)
+                continue
+            end += 2
+            if index < start:
                 self.make_token(TEXT, template[index:start], index)
-            if match.lastgroup != TAG_COMMENT_OPEN:
-                self.extract_tokens(template[start: end], match)
+            if symbol != OPEN_COMMENT:
+                self.extract_tokens(template, start, end)
             index = end
-        if template[index:]:
+            match = search(template, end)
+        if index < len(template):
             self.make_token(TEXT, template[index:], index)
         return self.tokens
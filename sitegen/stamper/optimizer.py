@@ -0,0 +1,157 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+from . import tree
+
+
+# longer strings are computed on render, only if used
+MAX_FOLDED_LENGTH = 1024
+
+# attributes of the nodes holding expressions and statement lists
+EXPRESSION_ATTRS = ('value', 'rvalue')
+LIST_ATTRS = ('args', 'children', 'true_block', 'false_block')
+
+
+def child_nodes(node):
+    for name in EXPRESSION_ATTRS:
+        value = getattr(node, name, None)
+        if isinstance(value, tree.Node):
+            yield value
+    for name in LIST_ATTRS:
+        for child in getattr(node, name, None) or []:
+            if isinstance(child, tree.Node):
+                yield child
+
+
+def count_nodes(node):
+    return 1 + sum(count_nodes(child) for child in child_nodes(node))
+
+
+def constant_value(node):
+    '''Return (True, value) if the node always renders to value'''
+    if isinstance(node, (tree.Constant, tree.String)):
+        return True, node.value
+    return False, None
+
+
+class Optimizer:
+    '''Simplify a parsed tree without changing what it renders'''
+    def optimize(self, root):
+        before = count_nodes(root)
+        root.children = self.statements(root.children)
+        root.removed_nodes = before - count_nodes(root)
+        return root
+
+    def statements(self, nodes):
+        '''Return an optimized list of statements'''
+        result = []
+        for node in nodes:
+            for item in self.statement(node):
+                # adjacent texts are rendered as one
+                if (isinstance(item, tree.Text) and result
+                        and type(result[-1]) is tree.Text):
+                    merged = tree.Text(result[-1].value + item.value,
+                                       result[-1].token)
+                    merged.parser = result[-1].parser
+                    result[-1] = merged
+                elif not (isinstance(item, tree.Text) and not item.value):
+                    result.append(item)
+        return result
+
+    def statement(self, node):
+        '''Return the statements replacing a node'''
+        if not isinstance(node, tree.Node):
+            return [node]
+        self.fold_attrs(node)
+        if isinstance(node, tree.Condition):
+            folded, value = constant_value(node.value)
+            if folded:
+                # the branch that never runs is dropped
+                block = node.true_block if value else node.false_block
+                return self.statements(block or [])
+            node.true_block = self.statements(node.true_block or [])
+            if node.false_block:
+                node.false_block = self.statements(node.false_block)
+            return [node]
+        if isinstance(node, tree.WhileLoop):
+            folded, value = constant_value(node.value)
+            if folded and not value:
+                return []
+        if type(node) is tree.Block:
+            return self.statements(node.children)
+        if isinstance(node, tree.PrintCommand):
+            folded, value = constant_value(node.value)
+            if folded:
+                text = tree.Text(node.format(value), node.token)
+                text.parser = node.parser
+                return [text]
+        if isinstance(node, (tree.Operation, tree.UnaryMinus)):
+            return [node]
+        node.children = self.statements(node.children)
+        return [node]
+
+    def fold_attrs(self, node):
+        if isinstance(node, tree.Operation):
+            node.children = [self.expression(child)
+                             for child in node.children]
+        elif isinstance(node, tree.UnaryMinus):
+            node.children = [self.expression(child)
+                             for child in node.children]
+        for name in EXPRESSION_ATTRS:
+            value = getattr(node, name, None)
+            if isinstance(value, tree.Node):
+                setattr(node, name, self.expression(value))
+        if isinstance(node, tree.FunctionCall):
+            node.args = [self.expression(arg) for arg in node.args]
+
+    def expression(self, node):
+        '''Return an expression node computing the same value'''
+        if isinstance(node, tree.Number):
+            return self.constant(node, int(node.value))
+        if isinstance(node, tree.Boolean):
+            return self.constant(node, {'true': True,
+                                        'false': False}[node.value])
+        self.fold_attrs(node)
+        if isinstance(node, tree.Operation):
+            values = []
+            for child in node.children:
+                folded, value = constant_value(child)
+                if not folded:
+                    return node
+                values.append(value)
+            try:
+                # same steps as Operation.render
+                value = values[0]
+                if len(values) > 1:
+                    for other in values[1:]:
+                        value = node.value(value, other)
+                else:
+                    value = node.value(value)
+            except (ZeroDivisionError, TypeError):
+                # the error is raised on render, with its position
+                return node
+            if isinstance(value, str) and len(value) > MAX_FOLDED_LENGTH:
+                return node
+            return self.constant(node, value)
+        return node
+
+    def constant(self, node, value):
+        constant = tree.Constant(value, node.token)
+        constant.parser = node.parser
+        return constant
+
+
+def optimize(root):
+    '''Optimize a parsed tree in place and return it, counting
+    the removed nodes in its removed_nodes attribute'''
+    return Optimizer().optimize(root)
@@ -19,18 +19,27 @@ from . import exceptions
 from . import lexer
 from .lexer import OPMAP
 from . import tree
+from . import optimizer
+
+
+# parser fields read when rendering, to report errors and find files
+RENDER_FIELDS = ('include_path', 'filename', 'lines', 'dependencies')
 
 
 class Parser():
-    def __init__(self, text, include_path='', filename=None):
+    def __init__(self, text, include_path='', filename=None, optimize=True):
         self.text = text
+        self.optimize = optimize
         self.include_path = include_path
         self.tokens = lexer.Lexer().tokenize(text)
+        self.lines = lexer.LineTable(text)
         self.tok_index = 0
         self.filename = filename
         self.tok = self.tokens[self.tok_index] if self.tokens else None
         self.regions = {}
         self.base_template = None
+        # files this template depends on, shared with included parsers
+        self.dependencies = set()
         self.stmt_map = {
             lexer.IF: self.if_stmt,
             lexer.WHILE: self.while_stmt,
@@ -43,20 +52,18 @@ class Parser():
             lexer.RETURN: self.function_return,
             lexer.USE: self.use_stmt,
             lexer.REGION: self.region_stmt,
-            lexer.BREAK: self.break_stmt
+            lexer.BREAK: self.break_stmt,
+            lexer.CACHE: self.cache_stmt
         }
 
+    def __getstate__(self):
+        # trees saved by the tree cache keep only what renders use
+        state = {name: getattr(self, name) for name in RENDER_FIELDS}
+        state['tok'] = None
+        return state
+
     def search_line_error(self, index):
-        line = 1
-        col = 1
-        for i, char in enumerate(self.text):
-            if index == i:
-                return (line, col)
-            if char == '\n':
-                line += 1
-                col = 1
-            else:
-                col += 1
+        return self.lines.position(index)
 
     def error(self, msg, token=None):
         if self.filename:
@@ -272,10 +279,15 @@ class Parser():
         node = self.create_node(tree.PrintCommand, exp_node, token)
         return node
 
+    def add_dependency(self, filename):
+        self.dependencies.add(os.path.join(self.include_path, filename))
+
     def include_stmt(self):
         token = self.tok
         self.next_token()
         exp_node = self.expression()
+        if isinstance(exp_node, tree.String):
+            self.add_dependency(exp_node.value)
         node = self.create_node(tree.IncludeCommand, exp_node, token)
         return node
 
@@ -283,6 +295,8 @@ class Parser():
         token = self.tok
         self.next_token()
         exp_node = self.expression()
+        if isinstance(exp_node, tree.String):
+            self.add_dependency(exp_node.value)
         node = self.create_node(tree.ParseCommand, exp_node, Parser, token)
         return node
 
@@ -305,7 +319,7 @@ class Parser():
         if self.tok.type != lexer.STRING:
             self.error('String expected')
         region_name = self.tok.value
-        node = self.create_node(tree.Node, region_name, token)
+        node = self.create_node(tree.Block, region_name, token)
         self.next_token()
         node.add_child(self.stmt_block())
         if self.base_template:
@@ -372,7 +386,15 @@ class Parser():
     def break_stmt(self):
         token = self.tok
         self.next_token()
-        return self.create_node(tree.BreakCommand, token)
+        return self.create_node(tree.BreakCommand, None, token)
+
+    def cache_stmt(self):
+        token = self.tok
+        self.next_token()
+        exp_node = self.expression()
+        node = self.create_node(tree.CacheBlock, exp_node, token)
+        node.add_child(self.stmt_block())
+        return node
 
     def print_tag_stmt(self, token):
         exp_node = self.expression()
@@ -430,11 +452,16 @@ class Parser():
         # parse the base template and return it instead
         if self.base_template:
             filename = os.path.join(self.include_path, self.base_template)
+            self.dependencies.add(filename)
             try:
                 fp = open(filename, 'r')
             except IOError:
                 self.error('File {!r} not found'.format(filename))
-            p = Parser(fp.read(), include_path=self.include_path)
+            p = Parser(fp.read(), include_path=self.include_path,
+                       optimize=self.optimize)
             fp.close()
+            p.dependencies = self.dependencies
             tree_root = p.parse(regions=self.regions)
+        elif self.optimize:
+            optimizer.optimize(tree_root)
         return tree_root
@@ -0,0 +1,85 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+
+class Scope(dict):
+    '''The names set in a render frame, over the scope or dict of the
+    frame around it. Names missing here are read from the layers below,
+    which are not changed while this frame is in use, since names are
+    always set in the frame being rendered'''
+    __slots__ = ('parent',)
+
+    def __init__(self, parent, names=()):
+        super().__init__(names)
+        self.parent = parent
+
+    def __missing__(self, key):
+        value = self.parent[key]
+        # kept to be read again without method calls
+        dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.parent
+
+    def flatten(self):
+        '''Return a dict of the names seen in this frame'''
+        names = dict(self.parent.items())
+        names.update(dict.items(self))
+        return names
+
+    def keys(self):
+        return self.flatten().keys()
+
+    def values(self):
+        return self.flatten().values()
+
+    def items(self):
+        return self.flatten().items()
+
+    def __iter__(self):
+        return iter(self.flatten())
+
+    def __len__(self):
+        return len(self.flatten())
+
+    def __repr__(self):
+        return repr(self.flatten())
+
+    def __eq__(self, other):
+        if isinstance(other, Scope):
+            other = other.flatten()
+        return self.flatten() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def copy(self):
+        '''Return a scope with the same names, whose frames are
+        changed apart from these'''
+        parent = self.parent
+        if isinstance(parent, Scope):
+            parent = parent.copy()
+        return Scope(parent, dict.items(self))
+
+
+def frame(context):
+    '''Return a scope for the names set by a render, keeping
+    the given context unchanged'''
+    return context if isinstance(context, Scope) else Scope(context)
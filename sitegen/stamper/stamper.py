@@ -12,12 +12,35 @@ License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
 '''
 
 from . import parser
+from . import compiler
 
 
 class Stamper:
-	def __init__(self, text, include_path=''):
+	def __init__(self, text, include_path='', compiled=False, cache=None):
 		self.include_path = include_path
-		self.tree = parser.Parser(text, include_path=include_path).parse()
+		self.tree = None
+		if cache:
+			self.tree = cache.load(text, include_path, compiled)
+		if self.tree is None:
+			self.tree = parser.Parser(text, include_path=include_path).parse()
+			if compiled:
+				# worth it for templates rendered many times
+				self.tree = compiler.compile_tree(self.tree)
+			if cache:
+				cache.save(text, include_path, compiled, self.tree)
+		# the parser of the tree shares the dependencies of its chain
+		self.parser = self.tree.parser
+
+	@property
+	def dependencies(self):
+		'''Files used by the template, found when parsed. The files
+		read by a render are added to the set given in its context
+		as render_dependencies'''
+		return self.parser.dependencies
 
 	def render(self, context) -> str:
 		return self.tree.render(context)
+
+	def stream(self, context, write):
+		'''Render passing the output to write in chunks'''
+		self.tree.stream(context, write)
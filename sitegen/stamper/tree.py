@@ -13,9 +13,68 @@ License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
 
 import os
 from datetime import datetime
+from itertools import islice
 import operator
 
-from .exceptions import BreakStatement, FunctionReturn, FileNotFoundError
+from .exceptions import (BreakStatement, FunctionReturn, FileNotFoundError,
+                         RenderError)
+from .scope import Scope, frame
+
+
+# context name of the set of files read by a render
+RENDER_DEPENDENCIES = 'render_dependencies'
+
+# the dict attribute of a class holding the items read by templates
+item_attrs = {}
+
+
+def item_attr(cls):
+    if cls not in item_attrs:
+        item_attrs[cls] = getattr(cls, 'template_items', None)
+    return item_attrs[cls]
+
+
+def add_render_dependencies(context, filenames):
+    '''Keep the files read by a render in the set of its context,
+    since the parsed tree is shared by the renders'''
+    dependencies = context.get(RENDER_DEPENDENCIES)
+    if dependencies is not None:
+        dependencies.update(filenames)
+
+
+def get_item(ref, part):
+    '''Return an item of a value, or an empty string'''
+    cls = ref.__class__
+    if cls is LoopItem:
+        if part == 'loop':
+            return ref.loop
+        ref = ref.item
+        cls = ref.__class__
+    if cls is Scope:
+        return ref.get(part, '')
+    if cls is not dict:
+        attr = item_attrs.get(cls) or item_attr(cls)
+        if not attr:
+            return ref[part] if part in ref else ''
+        ref = getattr(ref, attr)
+    # the same steps, without the method calls
+    return ref[part] if part in ref else ''
+
+
+def lookup(context, path):
+    '''Return the value of a dotted name, split in a tuple of parts,
+    or an empty string'''
+    try:
+        # a name set in the frame itself is read without method calls
+        ref = context[path[0]]
+    except KeyError:
+        ref = ''
+    for part in path[1:]:
+        if ref.__class__ is dict:
+            ref = ref[part] if part in ref else ''
+        else:
+            ref = get_item(ref, part)
+    return ref
 
 
 class Node:
@@ -24,14 +83,8 @@ class Node:
         self.token = token
         self.children = []
 
-    def lookup_context(self, context, name):
-        name = name.split('.')
-        ref = context.get(name[0], '')
-        for part in name[1:]:
-            if part not in ref:
-                return ''
-            ref = ref[part]
-        return ref
+    def lookup_context(self, context, path):
+        return lookup(context, path)
 
     def add_child(self, child):
         if isinstance(child, list):
@@ -43,24 +96,52 @@ class Node:
         return ''.join(output_list)
 
     def render(self, context):
+        return self.render_children(context, self.children)
+
+    def stream(self, context, write):
+        '''Pass the output to write in chunks instead of returning it.
+        Statements return the BreakStatement or FunctionReturn ending
+        the blocks around them, without raising it'''
+        write(str(self.render(context)))
+
+    def stream_children(self, context, children, write):
+        # on a break, the output written so far is kept
+        for child in children:
+            status = child.stream(context, write)
+            if status:
+                return status
+
+    def render_children(self, context, children):
         output = []
-        for child in self.children:
-            try:
-                child_output = str(child.render(context))
-            except BreakStatement as break_stmt:
-                partial_output = self.build_output(output)
-                break_stmt.partial_output = partial_output
-                raise break_stmt
-            output.append(child_output)
-        return self.build_output(output)
+        status = self.stream_children(context, children, output.append)
+        return self.build_status_output(output, status)
+
+    def render_stream(self, context):
+        '''Render a statement with its stream method'''
+        output = []
+        status = self.stream(context, output.append)
+        return self.build_status_output(output, status)
+
+    def build_status_output(self, output, status):
+        output = self.build_output(output)
+        if status:
+            # raised for the callers of render, like compiled templates
+            status.partial_output = output
+            raise status
+        return output
 
-    def load_file(self, filename, path=''):
+    def load_file(self, filename, path='', context=None):
         if not isinstance(filename, str):
-            self.error(RuntimeError, 'String expected')
+            self.error(RenderError, 'String expected')
         filename = os.path.join(path, filename)
+        includes = (context.get('include_cache') if context is not None
+                    else None)
         try:
-            with open(filename, 'r') as fp:
-                file_content = fp.read()
+            if includes:
+                file_content = includes.read(filename)
+            else:
+                with open(filename, 'r') as fp:
+                    file_content = fp.read()
         except IOError:
             msg = 'File {!r} not found'.format(filename)
             self.error(FileNotFoundError, msg)
@@ -73,27 +154,53 @@ class Node:
         return '{} - [{}]\n'.format(type(self), str(self.value))
 
 
-class Root(Node):
+class Block(Node):
+    '''A sequence of statements, streamed one at a time'''
+    def stream(self, context, write):
+        return self.stream_children(context, self.children, write)
+
+
+class Root(Block):
+    # nodes taken out by the optimizer
+    removed_nodes = 0
+
     def render(self, context):
+        output = []
+        self.stream(context, output.append)
+        return self.build_output(output)
+
+    def stream(self, context, write):
+        self.run(self.stream_children, frame(context), self.children, write)
+
+    def run(self, method, *args):
         try:
-            output = super().render(context)
-        except (RuntimeError, FileNotFoundError) as err:
+            status = method(*args)
+            if status:
+                raise status
+        except (RenderError, FileNotFoundError) as err:
             err.parser.error(err, err.token)
         except BreakStatement as break_stmt:
-            err.parser.error('Invalid break statement', break_stmt.token)
+            self.parser.error('Invalid break statement', break_stmt.token)
         except FunctionReturn as func_return:
-            err.parser.error('Invalid return statement', func_return.token)
-        return output
+            self.parser.error('Invalid return statement', func_return.token)
 
 
 class Text(Node):
     def render(self, _):
         return self.value
 
+    def stream(self, _, write):
+        write(self.value)
+
 
 class Variable(Node):
+    def __init__(self, value, token=None):
+        super().__init__(value, token)
+        # split once instead of on every render
+        self.path = tuple(value.split('.'))
+
     def render(self, context):
-        return self.lookup_context(context, self.value)
+        return self.lookup_context(context, self.path)
 
 
 class Number(Node):
@@ -106,6 +213,12 @@ class String(Node):
         return self.value
 
 
+class Constant(Node):
+    '''A value computed when the template was parsed'''
+    def render(self, _):
+        return self.value
+
+
 class Boolean(Node):
     def render(self, _):
         vmap = {'true': True, 'false': False}
@@ -129,9 +242,9 @@ class Operation(Node):
             else:
                 output = self.value(output)
         except ZeroDivisionError:
-            self.error(RuntimeError, 'Division by zero')
+            self.error(RenderError, 'Division by zero')
         except TypeError:
-            self.error(RuntimeError, 'Wrong types in operation')
+            self.error(RenderError, 'Wrong types in operation')
         return output
 
 
@@ -141,30 +254,100 @@ class Condition(Node):
         self.true_block = None
         self.false_block = None
 
-    def render(self, context):
+    def select_block(self, context):
         if self.value.render(context):
-            self.children = self.true_block
+            return self.true_block
         elif self.false_block:  # just check if there's an ELSE clause
-            self.children = self.false_block
-        else:
-            self.children = []
-        return super().render(context)
+            return self.false_block
+        return []
+
+    def render(self, context):
+        return self.render_children(context, self.select_block(context))
+
+    def stream(self, context, write):
+        return self.stream_children(context, self.select_block(context),
+                                    write)
 
 
-class WhileLoop(Node):
+class Loop(Node):
+    def stream_body(self, context, write):
+        try:
+            return self.stream_children(context, self.children, write)
+        except BreakStatement as break_stmt:
+            # raised by a function call in the loop
+            write(break_stmt.partial_output)
+            return break_stmt
+
+    def end_status(self, status):
+        # a break ends the loop, a return the function around it
+        return None if isinstance(status, BreakStatement) else status
+
     def render(self, context):
-        output = []
+        return self.render_stream(context)
+
+
+class WhileLoop(Loop):
+    def stream(self, context, write):
         while self.value.render(context):
-            try:
-                text = super().render(context)
-            except BreakStatement as break_stmt:
-                output.append(break_stmt.partial_output)
-                break
-            output.append(text)
-        return self.build_output(output)
+            status = self.stream_body(context, write)
+            if status:
+                return self.end_status(status)
 
 
-class ListNode(Node):
+class CacheBlock(Node):
+    '''A block whose output is kept by key in the fragment cache
+    of the context, rendered once while the key is the same'''
+    def tracked(self, context):
+        # collections remembering how they were read
+        return {name: value for name, value in context.items()
+                if hasattr(value, 'merge_usage')}
+
+    def render(self, context):
+        return self.render_stream(context)
+
+    def stream(self, context, write):
+        cache = context.get('fragment_cache')
+        if cache is None:
+            return self.stream_children(context, self.children, write)
+        key = str(self.value.render(context))
+        entry = cache.get(key)
+        if entry:
+            output, usage = entry
+            # the reads of the first render count for this one too
+            for name, value in self.tracked(context).items():
+                if usage.get(name):
+                    value.merge_usage(usage[name])
+            add_render_dependencies(context, usage.get(RENDER_DEPENDENCIES,
+                                                       ()))
+            write(output)
+            return None
+        output = []
+        # files read by the block, kept with its output
+        dependencies = context.get(RENDER_DEPENDENCIES)
+        context[RENDER_DEPENDENCIES] = read = set()
+        try:
+            status = self.stream_children(context, self.children,
+                                          output.append)
+        except BreakStatement as break_stmt:
+            break_stmt.partial_output = (self.build_output(output)
+                                         + break_stmt.partial_output)
+            raise
+        finally:
+            context[RENDER_DEPENDENCIES] = dependencies
+            add_render_dependencies(context, read)
+        output = self.build_output(output)
+        write(output)
+        if status:
+            # ended by a break or return, not cached
+            return status
+        usage = {name: value.usage()
+                 for name, value in self.tracked(context).items()}
+        usage[RENDER_DEPENDENCIES] = sorted(read)
+        cache.set(key, output, usage)
+        return None
+
+
+class ListNode(Loop):
     def __init__(self, iter_name, collection_name, token, reverse=False, limit=None):
         super().__init__('list {} as {}'.format(collection_name, iter_name), token)
         self.iter_name = iter_name
@@ -173,56 +356,132 @@ class ListNode(Node):
         self.limit = limit
 
     def update_iteration_counters(self, context, collection, index):
+        counter = LoopCounter(collection, index)
         item = context[self.iter_name]
-        counter = item['loop'] = {}
-        counter['first'] = True if index == 0 else False
-        counter['last'] = True if index == len(collection) - 1 else False
-        counter['index'] = index
-        counter['length'] = len(collection)
+        # only items holding names get the counters, as before, so
+        # strings and numbers keep their values in expressions
+        if hasattr(item, '__setitem__') and not isinstance(item, list):
+            # the item may be shared, so the counters are not stored on it
+            context[self.iter_name] = LoopItem(item, counter)
 
-    def render(self, context):
-        output = []
-        collection = context.get(self.collection_name)
-        loop_context = context.copy()
-        if self.reverse:
+    def reverse_items(self, collection):
+        try:
+            return reversed(collection)
+        except TypeError:
             collection = list(collection)
             collection.reverse()
-        for index, item in enumerate(collection):
-            if self.limit and index > self.limit - 1:
-                break
+            return collection
+
+    def iterate(self, context):
+        '''Yield the context of each iteration'''
+        collection = context.get(self.collection_name)
+        loop_context = Scope(context)
+        # items are only read as far as the limit goes
+        items = self.reverse_items(collection) if self.reverse else collection
+        if self.limit:
+            items = islice(items, self.limit)
+        for index, item in enumerate(items):
             loop_context[self.iter_name] = item
             self.update_iteration_counters(loop_context, collection, index)
-            try:
-                text = super().render(loop_context)
-            except BreakStatement as break_stmt:
-                output.append(break_stmt.partial_output)
-                break
-            output.append(text)
-        return self.build_output(output)
+            yield loop_context
+
+    def stream(self, context, write):
+        for loop_context in self.iterate(context):
+            status = self.stream_body(loop_context, write)
+            if status:
+                return self.end_status(status)
+
+
+class LoopCounter(dict):
+    '''The iteration counters of a list loop. The length of the
+    collection is only read if last or length are used'''
+    __slots__ = ('collection',)
+    sized_keys = ('last', 'length')
+
+    def __init__(self, collection, index):
+        super().__init__(first=index == 0, index=index)
+        self.collection = collection
+
+    def __missing__(self, key):
+        if key not in self.sized_keys:
+            raise KeyError(key)
+        length = len(self.collection)
+        self['length'] = length
+        self['last'] = self['index'] == length - 1
+        return self[key]
+
+    def __contains__(self, key):
+        return key in self.sized_keys or dict.__contains__(self, key)
+
+
+class LoopItem:
+    '''An item of a list loop along with its iteration counters'''
+    def __init__(self, item, loop):
+        self.item = item
+        self.loop = loop
+
+    def __contains__(self, key):
+        return key == 'loop' or key in self.item
+
+    def __getitem__(self, key):
+        if key == 'loop':
+            return self.loop
+        return self.item[key]
+
+    def __str__(self):
+        return str(self.item)
+
+
+class Function:
+    '''A function defined in a render, bound to its own context'''
+    def __init__(self, node, context):
+        self.node = node
+        self.context = context
+
+    def call(self, args):
+        return self.node.call(self.context, args)
+
+    def __str__(self):
+        return str(self.node)
 
 
 class FunctionNode(Node):
     def __init__(self, value, params, token):
         super().__init__(value, token)
         self.params = params
-        self.context = {}
 
-    def call(self, args):
+    def call(self, context, args, body=None):
+        '''Run the function, by default rendering its children,
+        or with the body of a compiled template'''
         received, expected = len(args), len(self.params)
         if expected > received:
             msg = 'Expected {} params, received {}'.format(expected, received)
-            self.error(RuntimeError, msg)
+            self.error(RenderError, msg)
         scoped_context = dict(zip(self.params, args))
-        self.context.update(scoped_context)
+        context.update(scoped_context)
+        if body:
+            try:
+                return body(context)
+            except FunctionReturn as func_return:
+                return func_return.return_value
+        output = []
         try:
-            output = super().render(self.context)
-        except FunctionReturn as func_return:
-            return func_return.return_value
-        return output
+            status = self.stream_children(context, self.children,
+                                          output.append)
+        except BreakStatement as break_stmt:
+            # raised by a function call, ends the loop calling this
+            break_stmt.partial_output = (self.build_output(output)
+                                         + break_stmt.partial_output)
+            raise
+        if isinstance(status, FunctionReturn):
+            return status.return_value
+        # a break outside a loop ends the loop calling the function
+        return self.build_status_output(output, status)
 
     def render(self, context):
-        context[self.value] = self
-        self.context = context.copy()
+        function = Function(self, None)
+        context[self.value] = function
+        function.context = context.copy()
         return ''
 
 
@@ -230,25 +489,31 @@ class FunctionCall(Node):
     def __init__(self, value, args, token):
         super().__init__(value, token)
         self.args = args
+        self.path = tuple(value.split('.'))
 
     def render(self, context):
-        func = self.lookup_context(context, self.value)
+        func = self.lookup_context(context, self.path)
         if not func:
             msg = 'Function {!r} not defined'.format(self.value)
-            self.error(RuntimeError, msg)
+            self.error(RenderError, msg)
         args = [arg.render(context) for arg in self.args]
         return func.call(args)
 
 
 class ReturnCommand(Node):
     def render(self, context):
-        return_value = self.value.render(context)
-        raise FunctionReturn(self.token, return_value)
+        return self.render_stream(context)
+
+    def stream(self, context, write):
+        return FunctionReturn(self.token, self.value.render(context))
 
 
 class BreakCommand(Node):
-    def render(self, _):
-        raise BreakStatement(token=self.token)
+    def render(self, context):
+        return self.render_stream(context)
+
+    def stream(self, context, write):
+        return BreakStatement(token=self.token)
 
 
 class PrintCommand(Node):
@@ -256,8 +521,7 @@ class PrintCommand(Node):
         super().__init__(value, token)
         self.tag_filter = tag_filter
 
-    def render(self, context):
-        value = self.value.render(context)
+    def format(self, value):
         if isinstance(value, datetime):
             if self.tag_filter:
                 value = value.strftime(self.tag_filter)
@@ -265,12 +529,20 @@ class PrintCommand(Node):
                 value = value.strftime('%Y-%m-%d %H:%M:%S')
         return str(value)
 
+    def render(self, context):
+        return self.format(self.value.render(context))
+
+    def stream(self, context, write):
+        write(self.format(self.value.render(context)))
+
 
 class IncludeCommand(Node):
     def render(self, context):
         path = self.parser.include_path
         filename = self.value.render(context)
-        return self.load_file(filename, path)
+        content = self.load_file(filename, path, context)
+        add_render_dependencies(context, [os.path.join(path, filename)])
+        return content
 
 
 class ParseCommand(Node):
@@ -278,18 +550,39 @@ class ParseCommand(Node):
         super().__init__(value, token)
         self.parser_cls = parser
 
-    def render(self, context):
+    def parse(self, context):
+        '''Return the tree of the file and the files it uses'''
         path = self.parser.include_path
         filename = self.value.render(context)
-        file_content = self.load_file(filename, path)
+        includes = context.get('include_cache')
+        if includes and isinstance(filename, str):
+            # parsed once by build, keyed by the file path
+            cached = includes.get_tree(path, os.path.join(path, filename))
+            if cached:
+                return cached
+        file_content = self.load_file(filename, path, context)
         try:
             p = self.parser_cls(file_content, include_path=path, filename=filename)
+            p.add_dependency(filename)
             subtree = p.parse()
         except RuntimeError:
             msg = '{} is including itself.'.format(filename)
-            self.error(RuntimeError, msg)
+            self.error(RenderError, msg)
+        if includes:
+            includes.add_tree(path, os.path.join(path, filename), subtree,
+                              p.dependencies)
+        return subtree, p.dependencies
+
+    def render(self, context):
+        subtree, dependencies = self.parse(context)
+        add_render_dependencies(context, dependencies)
         return subtree.render(context)
 
+    def stream(self, context, write):
+        subtree, dependencies = self.parse(context)
+        add_render_dependencies(context, dependencies)
+        subtree.stream(context, write)
+
 
 class Assignment(Node):
     def __init__(self, value, token):
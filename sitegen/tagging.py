@@ -0,0 +1,139 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import re
+
+from .paging import PageList
+
+
+def tag_id(name):
+    '''Return the form of a tag name used in paths and URLs'''
+    return re.sub(r'[^\w-]+', '-', str(name).strip().lower()).strip('-')
+
+
+def tag_key(name):
+    '''Return the form of a tag name that is the same for
+    the names of a tag'''
+    return str(name).strip().lower()
+
+
+class Tag:
+    '''Define a tag and the pages marked with it'''
+    def __init__(self, id, name):
+        self.id = id
+        self.pagelist = PageList()
+        self.props = {
+            'id': id,
+            'name': name,
+            'url': '',
+            'count': 0,
+            'pages': self.pagelist
+        }
+
+    def add_page(self, page):
+        self.pagelist.insert(page)
+        self.props['count'] = len(self.pagelist)
+
+    def __setitem__(self, key, value):
+        self.props[key] = value
+
+    def __getitem__(self, key):
+        return self.props.get(key)
+
+    def get_dict(self):
+        return self.props
+
+
+class TagIndex:
+    '''Pages by tag, read by templates as a mapping of tag ids to tags'''
+    def __init__(self):
+        self.items = {}
+        # tags by key, until they are given their ids
+        self.names = {}
+
+    def __iter__(self):
+        for key in sorted(self.items):
+            yield self.items[key].get_dict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __getitem__(self, key):
+        return self.items[key].get_dict()
+
+    def tags(self):
+        '''Return the tag objects ordered by id'''
+        return [self.items[key] for key in sorted(self.items)]
+
+    def add_page(self, page):
+        '''Add a page to the tags it lists'''
+        added = set()
+        for name in page.tags:
+            key = tag_key(name)
+            if not tag_id(key) or key in added:
+                continue
+            if key not in self.names:
+                self.names[key] = Tag(None, name)
+            self.names[key].add_page(page)
+            added.add(key)
+
+    def assign_ids(self):
+        '''Give each tag its id once all pages are added. Tags whose
+        names differ only by characters left out of ids, like "C" and
+        "C++", get a number added to the id, in the order of the names'''
+        self.items = {}
+        for key in sorted(self.names):
+            tag = self.names[key]
+            id = base_id = tag_id(key)
+            count = 1
+            while id in self.items:
+                count += 1
+                id = '{}-{}'.format(base_id, count)
+            tag.id = tag['id'] = id
+            self.items[id] = tag
+
+
+class TagUsage:
+    '''A view of the tag index that remembers if it was read'''
+    def __init__(self, index):
+        self.index = index
+        self.read = False
+
+    def usage(self):
+        return self.read or None
+
+    def merge_usage(self, usage):
+        self.read = self.read or bool(usage)
+
+    def __iter__(self):
+        self.read = True
+        return iter(self.index)
+
+    def __len__(self):
+        self.read = True
+        return len(self.index)
+
+    def __contains__(self, key):
+        self.read = True
+        return key in self.index
+
+    def __getitem__(self, key):
+        self.read = True
+        return self.index[key]
+
+    def __str__(self):
+        self.read = True
+        return str(list(self.index))
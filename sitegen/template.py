@@ -11,15 +11,17 @@ License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
 ===============================================================================
 '''
 
-import os
 import json
 import sys
+import threading
 
 from . import reader
 from . import utils
 from .paging import Page, PageList
 from .categorization import Category, CategoryList
 from .stamper.stamper import Stamper
+from .stamper.scope import Scope, frame
+from .stamper.tree import RENDER_DEPENDENCIES
 from .exceptions import TemplateError
 
 # set to env global date format
@@ -28,28 +30,80 @@ TEMPLATES_DIR = 'templates'
 DEFAULT_TEMPLATE = 'default'
 TEMPLATES_EXT = 'tpl'
 
+class TemplateRegistry:
+    '''Templates of the builds, each file read and parsed once
+    and shared by the pages rendered with it'''
+    def __init__(self, tree_cache=None):
+        self.tree_cache = tree_cache
+        self.trees = {}
+        self.hits = 0
+        self.misses = 0
+        # may be shared by render threads
+        self.lock = threading.Lock()
+
+    def get(self, path, include_path=''):
+        '''Return the parsed template of a file'''
+        with self.lock:
+            tree = self.trees.get(path)
+            if tree is not None:
+                self.hits += 1
+                return tree
+            self.misses += 1
+            try:
+                content = utils.read_file(path)
+            except FileNotFoundError:
+                raise FileNotFoundError('Template {!r}'
+                ' not found'.format(path))
+            tree = Stamper(content, include_path=include_path,
+                           compiled=True, cache=self.tree_cache)
+            self.trees[path] = tree
+            return tree
+
+    def __getstate__(self):
+        # parsed templates are not sent to other processes
+        return (self.tree_cache,)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def clear(self):
+        '''Forget the templates, read again when used'''
+        with self.lock:
+            self.trees.clear()
+
 
 class Template:
     def __init__(self, id, path):
         self.id = id
-        if not os.path.exists(path):
-            raise FileNotFoundError('Template {!r}'
-            ' not found'.format(path))
-        self.content = utils.read_file(path)
         self.path = path
         self.include_path = ''
+        self.dependencies = set([path])
+
+    def load_tree(self, context):
+        tree = context['templates'].get(self.path, self.include_path)
+        if 'page' in context:
+            page_content = context['page'].get('content', '')
+            content_tree = Stamper(page_content)
+            context['page']['content'] = content_tree.render(context)
+            self.dependencies.update(content_tree.dependencies)
+        return tree
 
     def render(self, context):
-        cache = context['template_cache']
-        if self.id in cache.keys():
-            tree = cache[self.id]
-        else:
-            tree = Stamper(self.content, include_path=self.include_path)
-            cache[self.id] = tree
-            if 'page' in context:
-                page_content = context['page'].get('content', '')
-                context['page']['content'] = Stamper(page_content).render(context)
-        return tree.render(context)
+        # the names set by the content are seen by the template
+        context = frame(context)
+        context[RENDER_DEPENDENCIES] = rendered = set()
+        tree = self.load_tree(context)
+        output = tree.render(context)
+        self.dependencies.update(tree.dependencies, rendered)
+        return output
+
+    def stream(self, context, write):
+        '''Render passing the output to write in chunks'''
+        context = frame(context)
+        context[RENDER_DEPENDENCIES] = rendered = set()
+        tree = self.load_tree(context)
+        tree.stream(context, write)
+        self.dependencies.update(tree.dependencies, rendered)
 
 
 class JSONTemplate(Template):
@@ -57,7 +111,7 @@ class JSONTemplate(Template):
         pass
 
     def render(self, page):
-        page_data = page.data.copy()
+        page_data = page.data.read()
         page_data['date'] = page['date'].strftime(DATE_FORMAT)
         return json.dumps(page_data, skipkeys=True)
 
@@ -87,11 +141,17 @@ class HTMLTemplate(Template):
         links = [f for f in links if f.endswith('.js')]
         return self.build_external_tags(links, script_tpl)
 
-    def render(self, page, env):
-        page_data = page.data.copy()
-        page_data.update({
+    def set_page(self, page, env):
+        # the rendered content is set over the page data
+        env['page'] = Scope(page.data, {
             'styles': self.build_style_tags(page.styles),
             'scripts': self.build_script_tags(page.scripts)
         })
-        env['page'] = page_data
+
+    def render(self, page, env):
+        self.set_page(page, env)
         return super().render(env)
+
+    def stream(self, page, env, write):
+        self.set_page(page, env)
+        super().stream(env, write)
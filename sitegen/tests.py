@@ -11,11 +11,33 @@ License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
 ===============================================================================
 '''
 
+import io
+import os
+import json
+import threading
+import urllib.request
 import unittest
 import tempfile
+import contextlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from . import reader
 from . import site
+from . import parallel
+from . import server
+from . import daemon
+from .exceptions import PageValueError
+from .paging import Page, PageList, PageListing
+from .manifest import BuildManifest
+from .pagecache import PageDataCache
+from .discovery import DirectoryIndex
+from .stamper.stamper import Stamper
+from .stamper.parser import Parser
+from .stamper.lexer import Lexer, LineTable
+from .stamper import tree
+from .stamper.scope import Scope
+from .stamper.cache import TreeCache, IncludeCache, FragmentCache
 
 class TestReader(unittest.TestCase):
 
@@ -29,17 +51,31 @@ class TestReader(unittest.TestCase):
     def testTokenizeSingleKeyValue(self):
         text = ' title  =  Post title\n  '
         tokens = reader._tokenize(text)
-        self.assertEqual(tokens[0]['type'], 'name')
-        self.assertEqual(tokens[0]['value'], 'title')
+        self.assertEqual(tokens[0].type, 'name')
+        self.assertEqual(tokens[0].value, 'title')
 
-        self.assertEqual(tokens[1]['value'], '=')
-        self.assertEqual(tokens[0]['type'], 'name')
-        self.assertEqual(tokens[2]['value'], 'Post title')
+        self.assertEqual(tokens[1].value, '=')
+        self.assertEqual(tokens[0].type, 'name')
+        self.assertEqual(tokens[2].value, 'Post title')
 
     def testTokenizerContentValue(self):
         text = 'content\nExample text'
         tokens = reader._tokenize(text)
-        self.assertEqual(tokens[0]['value'], 'Example text')
+        self.assertEqual(tokens[0].value, 'Example text')
+
+    def testParseMixedLines(self):
+        text = ('title = A\\, B\n'
+            'tags = [x, y]\n'
+            'group = {\n'
+            '    name = value\n'
+            '}\n'
+            'content\n'
+            'body')
+        self.assertEqual(reader.parse(text), {
+            'title': 'A, B', 'tags': ['x', 'y'],
+            'group': {'name': 'value'}, 'content': 'body'})
+        with self.assertRaisesRegex(PageValueError, 'at line 3, column 6'):
+            reader.parse('a = b\nc = d\ne = [,]')
 
 
 class TestTemplate(unittest.TestCase):
@@ -57,5 +93,845 @@ class TestTemplate(unittest.TestCase):
         assert template.path == self.file.name
 
 
+class TestBuildManifest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.input = os.path.join(self.dir.name, 'page.me')
+        self.output = os.path.join(self.dir.name, 'index.html')
+        for path in (self.input, self.output):
+            with open(path, 'w') as fp:
+                fp.write(path)
+        self.manifest_path = os.path.join(self.dir.name, 'manifest.json')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def build(self):
+        manifest = BuildManifest(self.manifest_path)
+        manifest.load()
+        return manifest
+
+    def testUnchangedOutputIsFresh(self):
+        manifest = self.build()
+        manifest.record('page', 'key', [self.input], self.output)
+        manifest.rotate()
+        manifest.save()
+        manifest = self.build()
+        self.assertTrue(manifest.is_fresh('page', 'key', [self.input],
+                                          self.output))
+        self.assertFalse(manifest.is_fresh('page', 'other', [self.input],
+                                           self.output))
+
+    def testChangedInputIsStale(self):
+        manifest = self.build()
+        manifest.record('page', 'key', [self.input], self.output)
+        manifest.rotate()
+        manifest.save()
+        with open(self.input, 'a') as fp:
+            fp.write('changed')
+        manifest = self.build()
+        self.assertFalse(manifest.is_fresh('page', 'key', [self.input],
+                                           self.output))
+
+    def testUnusedFilesForgotten(self):
+        manifest = self.build()
+        manifest.record('page', 'key', [self.input], self.output)
+        manifest.rotate()
+        manifest.record('other', 'key', [], self.output)
+        manifest.rotate()
+        manifest.save()
+        self.assertEqual(list(self.build().files), [self.output])
+
+    def testSharedDigestIsChecked(self):
+        manifest = self.build()
+        manifest.record('page', 'key', [], self.output, {'listing': 'a'})
+        manifest.rotate()
+        manifest.save()
+        manifest = self.build()
+        self.assertTrue(manifest.is_fresh('page', 'key', [], self.output,
+            {'listing': lambda value: value == 'a'}))
+        self.assertFalse(manifest.is_fresh('page', 'key', [], self.output,
+            {'listing': lambda value: value == 'b'}))
+        self.assertFalse(manifest.is_fresh('page', 'key', [], self.output))
+
+
+class TestPageDataCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.page = os.path.join(self.dir.name, 'page.me')
+        self.write('title = one')
+        self.parsed = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, text):
+        with open(self.page, 'w') as fp:
+            fp.write(text)
+
+    def parse(self, text):
+        self.parsed.append(text)
+        return reader.parse(text)
+
+    def cache(self):
+        cache = PageDataCache(os.path.join(self.dir.name, 'pages.bin'))
+        cache.load()
+        return cache
+
+    def testUnchangedFileIsNotParsed(self):
+        cache = self.cache()
+        cache.parse(self.page, self.parse)
+        cache.save()
+        data = self.cache().parse(self.page, self.parse)
+        self.assertEqual(data, {'title': 'one'})
+        self.assertEqual(len(self.parsed), 1)
+
+    def testChangedFileIsParsed(self):
+        cache = self.cache()
+        cache.parse(self.page, self.parse)
+        cache.save()
+        self.write('title = two')
+        data = self.cache().parse(self.page, self.parse)
+        self.assertEqual(data, {'title': 'two'})
+        self.assertEqual(len(self.parsed), 2)
+
+    def testContentIsReadWhenUsed(self):
+        self.write('title = one\ncontent\n first<!-- more -->second\n')
+        cache = self.cache()
+        data = cache.parse(self.page, self.parse)
+        self.assertEqual(data, {'title': 'one'})
+        self.assertEqual(cache.entries[self.page][3], {'title': 'one'})
+        self.assertIn('content', data)
+        self.assertEqual(data['content'], 'firstsecond')
+        self.assertEqual(data.get('excerpt'), 'first')
+        self.assertEqual(data.read(), {'title': 'one',
+            'content': 'firstsecond', 'excerpt': 'first'})
+
+
+class TestDirectoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        root = self.dir.name
+        for dirname in ('a', 'a/b', 'c', 'skip'):
+            os.makedirs(os.path.join(root, dirname))
+        for filename in ('a/page.me', 'a/b/thumb.png', 'skip/page.me'):
+            open(os.path.join(root, filename), 'w').close()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def testScan(self):
+        root = self.dir.name
+        exclude = lambda path: path.endswith('skip')
+        for threads in (1, 4):
+            index = DirectoryIndex(exclude=exclude)
+            index.scan(root, threads)
+            self.assertEqual(sorted(index.subdirs(root)), [
+                os.path.join(root, name) for name in ('a', 'c', 'skip')])
+            self.assertTrue(index.has_file(os.path.join(root, 'a'),
+                                           'page.me'))
+            self.assertFalse(index.has_file(os.path.join(root, 'c'),
+                                            'page.me'))
+            self.assertNotIn(os.path.join(root, 'skip'), index.dirs)
+
+
+class ResidentSiteCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.write('config.me', 'blocked_dirs = [x]\n'
+                   'default_template = default\n')
+        self.write('templates/default.tpl', '{{page.title}}:{{page.content}}')
+        self.write('templates/other.tpl', '{{page.title}}')
+        for name in ('a', 'b'):
+            self.write('data/{}/page.me'.format(name),
+                       'title = {}\ncontent\nbody'.format(name))
+        props = reader.parse(self.read('config.me'))
+        self.site = site.Site(props, resident=True)
+        self.generate(self.site.generate, self.dir.name)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def read(self, name):
+        with open(self.path(name)) as fp:
+            return fp.read()
+
+    def write(self, name, content):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        with open(self.path(name), 'w') as fp:
+            fp.write(content)
+
+    def generate(self, method, *args):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return method(*args)
+
+
+class TestResidentSite(ResidentSiteCase):
+    def testUpdateChangedPage(self):
+        self.write('data/a/page.me', 'title = A\ncontent\nnew body')
+        pages = self.generate(self.site.update, [self.path('data/a/page.me')])
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(self.site.skipped, 1)
+        self.assertEqual(self.read('data/a/index.html'), 'A:new body')
+
+    def testUndatedPagesSkipped(self):
+        self.write('templates/default.tpl',
+                   '{% list pages as p: %}{{p.title}}{% end %}')
+        self.generate(self.site.generate, self.dir.name)
+        self.generate(self.site.generate, self.dir.name)
+        self.assertEqual(self.site.skipped, 2)
+
+    def testLimitedListingSkipsHiddenPages(self):
+        self.write('templates/default.tpl',
+                   '{% list pages as p limit 1: %}{{p.title}}{% end %}!')
+        for day, name in enumerate('ab'):
+            self.write('data/{}/page.me'.format(name), 'title = {}\n'
+                       'date = 2020-01-0{} 00:00:00\n'.format(name, day + 2))
+        self.generate(self.site.update, [self.dir.name])
+        self.write('data/c/page.me', 'title = c\ndate = 2020-01-01 00:00:00\n')
+        self.generate(self.site.update, [self.path('data/c')])
+        self.assertEqual(self.site.generated, [self.path('data/c')])
+        self.assertEqual(self.read('data/c/index.html'), 'b!')
+
+    def testUpdateIgnoresOutputs(self):
+        paths = [self.path('data/a/index.html')]
+        self.assertIsNone(self.generate(self.site.update, paths))
+
+    def testUpdateUnusedTemplate(self):
+        self.write('templates/other.tpl', '-')
+        paths = [self.path('templates/other.tpl')]
+        self.generate(self.site.update, paths)
+        self.assertEqual(self.site.skipped, 2)
+
+    def testRenderDependenciesOfEachPage(self):
+        self.write('templates/other.tpl', '{% parse page.side %}!')
+        for name in ('a', 'b'):
+            self.write('templates/s{}.tpl'.format(name), name)
+            self.write('data/{}/page.me'.format(name),
+                       'title = {0}\ntemplate = other\nside = s{0}.tpl\n'
+                       'content\nbody'.format(name))
+        self.generate(self.site.update, [self.dir.name])
+        for name in ('b', 'a'):
+            path = 'templates/s{}.tpl'.format(name)
+            self.write(path, name.upper())
+            self.generate(self.site.update, [self.path(path)])
+            self.assertEqual(self.site.generated,
+                             [self.path('data/' + name)])
+        self.assertEqual(self.read('data/a/index.html'), 'A!')
+
+    def testCachedFragmentDependencies(self):
+        self.write('templates/menu.tpl', 'menu')
+        self.write('templates/default.tpl', '{% m = "menu.tpl" %}'
+                   '{% cache "menu": %}{% include m %}{% end %}!')
+        for day, name in enumerate('ab'):
+            self.write('data/{}/page.me'.format(name), 'title = {}\n'
+                       'date = 2020-01-0{} 00:00:00\n'.format(name, day + 1))
+        self.generate(self.site.update, [self.dir.name])
+        self.write('templates/menu.tpl', 'new menu')
+        self.generate(self.site.update, [self.path('templates/menu.tpl')])
+        self.assertEqual(self.site.skipped, 0)
+        for name in 'ab':
+            self.assertEqual(self.read('data/{}/index.html'.format(name)),
+                             'new menu!')
+
+    def testListedContentUpdatesListings(self):
+        self.write('templates/other.tpl',
+                   '{% list pages as p: %}{{p.content}} {% end %}!')
+        self.write('data/a/page.me', 'title = a\ntemplate = other\n'
+                   'date = 2020-01-01 00:00:00\ncontent\nbody')
+        b = ('title = b\ndate = 2020-01-02 00:00:00\n'
+             'content\nexcerpt<!-- more -->')
+        self.write('data/b/page.me', b + ' body')
+        self.generate(self.site.update, [self.dir.name])
+        # the excerpt is the same
+        self.write('data/b/page.me', b + ' new body')
+        self.generate(self.site.update, [self.path('data/b/page.me')])
+        self.assertEqual(sorted(self.site.generated),
+                         [self.path('data/a'), self.path('data/b')])
+        self.assertIn('new body', self.read('data/a/index.html'))
+
+    def testDigestsKeptBetweenUpdates(self):
+        generator = self.site.generator
+        page = generator.page_objects[self.path('data/b')]
+        digests = dict(page.digests)
+        templates_key = generator.templates_key
+        self.write('data/a/page.me', 'title = A\ncontent\nnew body')
+        self.generate(self.site.update, [self.path('data/a/page.me')])
+        self.assertIs(generator.page_objects[self.path('data/b')], page)
+        for name, cached in digests.items():
+            self.assertIs(page.digests[name], cached)
+        self.assertEqual(generator.templates_key, templates_key)
+        self.write('templates/new.tpl', '-')
+        self.generate(self.site.update, [self.path('templates/new.tpl')])
+        self.assertNotEqual(generator.templates_key, templates_key)
+
+    def testTemplatesReadOnce(self):
+        templates = self.site.generator.templates
+        # default.tpl shared by both pages and the feed template
+        self.assertEqual((templates.misses, templates.hits), (2, 1))
+        self.write('templates/default.tpl', '{{page.title}}')
+        paths = [self.path('templates/default.tpl')]
+        self.generate(self.site.update, paths)
+        self.assertEqual((templates.misses, templates.hits), (3, 2))
+        self.assertEqual(self.read('data/b/index.html'), 'b')
+
+
+class TestTags(ResidentSiteCase):
+    def setUp(self):
+        super().setUp()
+        self.write('templates/tag.tpl',
+                   '{% list pages as p: %}{{p.title}}{% end %}')
+        self.write('templates/other.tpl', '{{tags.y.count}}')
+        self.write_page('a', 1, 'x, y', 'template = other\n')
+        self.write_page('b', 2, 'y')
+        self.site.props['tag_template'] = 'tag'
+        self.generate(self.site.update, [self.dir.name])
+
+    def write_page(self, name, day, tags, extra='', body='body'):
+        self.write('data/{}/page.me'.format(name),
+                   'title = {}\ndate = 2020-01-0{} 00:00:00\n'
+                   'tags = {}\n{}content\n{}'.format(name, day, tags,
+                                                      extra, body))
+
+    def testTagPages(self):
+        self.assertEqual(self.read('data/tags/y/index.html'), 'ba')
+        self.assertEqual(self.read('data/tags/x/index.html'), 'a')
+        self.assertEqual(self.read('data/a/index.html'), '2')
+
+    def testChangedTagsUpdateReaders(self):
+        self.write_page('b', 2, 'x')
+        self.generate(self.site.update, [self.path('data/b/page.me')])
+        self.assertEqual(sorted(self.site.generated),
+                         [self.path('data/a'), self.path('data/b')])
+        self.assertEqual(self.read('data/a/index.html'), '1')
+        self.assertEqual(self.read('data/tags/x/index.html'), 'ba')
+
+    def testCollidingTagIds(self):
+        self.write_page('a', 1, 'C++, y', 'template = other\n')
+        self.write_page('b', 2, 'c, y')
+        self.generate(self.site.update, [self.dir.name])
+        self.assertEqual(self.read('data/tags/c/index.html'), 'b')
+        self.assertEqual(self.read('data/tags/c-2/index.html'), 'a')
+
+    def testUnusedTagPagesRemoved(self):
+        self.write_page('a', 1, 'y', 'template = other\n')
+        self.generate(self.site.update, [self.path('data/a/page.me')])
+        self.assertFalse(os.path.exists(self.path('data/tags/x')))
+        self.assertEqual(self.read('data/tags/y/index.html'), 'ba')
+
+    def testChangedContentUpdatesTagPages(self):
+        self.write('templates/tag.tpl',
+                   '{% list pages as p: %}{{p.content}}{% end %}')
+        self.write_page('b', 2, 'y', extra='', body='a<!-- more -->b')
+        self.generate(self.site.update, [self.dir.name])
+        self.write_page('b', 2, 'y', extra='', body='a<!-- more -->c')
+        self.generate(self.site.update, [self.path('data/b/page.me')])
+        self.assertEqual(self.read('data/tags/y/index.html'), 'acbody')
+
+
+class TestBuildDaemon(ResidentSiteCase):
+    def setUp(self):
+        super().setUp()
+        self.daemon = daemon.BuildDaemon(self.site, self.load)
+
+    def load(self, path, resident=False):
+        with open(os.path.join(path, 'config.me')) as fp:
+            return site.Site(reader.parse(fp.read()), resident=resident)
+
+    def testRebuildConfig(self):
+        config = 'blocked_dirs = [x]\ndefault_template = default\ntitle = {}'
+        self.write('templates/default.tpl', '{{site.title}}')
+        self.write('config.me', config.format('Old'))
+        self.generate(self.daemon.rebuild, ['config.me'])
+        self.write('config.me', config.format('New'))
+        result = self.generate(self.daemon.rebuild, ['config.me'])
+        self.assertEqual(len(result['generated']), 2)
+        self.assertEqual(self.read('data/a/index.html'), 'New')
+
+    def testRebuildRelativePath(self):
+        self.write('data/b/page.me', 'title = B\ncontent\nbody')
+        result = self.generate(self.daemon.rebuild, ['data/b/page.me'])
+        self.assertEqual(result['generated'], [self.path('data/b')])
+        self.assertEqual(self.read('data/b/index.html'), 'B:body')
+
+    def testRequestOverHTTP(self):
+        httpd = daemon.create_server(self.daemon, '127.0.0.1', 0)
+        thread = threading.Thread(target=httpd.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}/rebuild'.format(httpd.server_port)
+            data = json.dumps({'paths': ['data/a/index.html']})
+            request = urllib.request.Request(url, data.encode('utf-8'))
+            with contextlib.redirect_stderr(io.StringIO()):
+                with urllib.request.urlopen(request) as response:
+                    result = json.loads(response.read().decode('utf-8'))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join()
+        self.assertEqual(result, {'generated': [], 'skipped': 2,
+                                  'pages': 2})
+
+
+class TestPreview(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.write('config.me', 'blocked_dirs = [x]\n'
+                   'default_template = default\n')
+        self.write('templates/default.tpl', '{{page.title}}:{{page.content}}')
+        self.write('data/a/page.me', 'title = a\ncontent\nbody')
+        self.preview = server.Preview(self.dir.name, 'http://test/',
+                                      self.load)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def load(self, path, resident=False):
+        with open(os.path.join(path, 'config.me')) as fp:
+            return site.Site(reader.parse(fp.read()), resident=resident)
+
+    def write(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as fp:
+            fp.write(content)
+
+    def testRenderOnRequest(self):
+        content_type, body, etag = self.preview.get('/a/')
+        self.assertEqual(body, b'a:body')
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name,
+                                                     'data/a/index.html')))
+        self.assertEqual(self.preview.get('/a/?x=1')[2], etag)
+        self.assertIsNone(self.preview.get('/b/'))
+
+    def testPublishedFilesOnly(self):
+        self.write('data/a/style.css', 'p {}')
+        self.write('data/x/secret.txt', 'secret')
+        self.assertEqual(self.preview.get('/a/style.css')[:2],
+                         ('text/css', b'p {}'))
+        for url in ('/a/page.me', '/config.me', '/data/a/page.me',
+                    '/templates/default.tpl', '/x/secret.txt',
+                    '/data/x/secret.txt'):
+            self.assertIsNone(self.preview.get(url), url)
+
+    def testChangedPage(self):
+        etag = self.preview.get('/a/')[2]
+        self.write('data/a/page.me', 'title = A\ncontent\nbody')
+        self.preview.invalidate([os.path.join(self.dir.name,
+                                              'data/a/page.me')])
+        _, body, new_etag = self.preview.get('/a/')
+        self.assertEqual(body, b'A:body')
+        self.assertNotEqual(new_etag, etag)
+
+
+class TestPageList(unittest.TestCase):
+    def setUp(self):
+        self.pagelist = PageList()
+        for name, day in [('a', 3), ('b', 1), ('c', 3), ('d', 2)]:
+            page = Page()
+            page.path = name
+            page.set_date(datetime(2020, 1, day), None)
+            self.pagelist.insert(page)
+
+    def paths(self, pages):
+        return [page.path for page in pages]
+
+    def testDateOrder(self):
+        # pages with the same date keep their insertion order
+        self.assertEqual(self.paths(self.pagelist), ['b', 'd', 'a', 'c'])
+        self.assertEqual(self.pagelist[-1].path, 'c')
+
+    def testBetween(self):
+        pages = self.pagelist.between(datetime(2020, 1, 2),
+                                      datetime(2020, 1, 3))
+        self.assertEqual(self.paths(pages), ['d'])
+
+
+class TestParallel(unittest.TestCase):
+    def testBatchesShareTemplate(self):
+        pages = []
+        for template in ['a', 'b', 'a', 'a', 'b']:
+            page = Page()
+            page.template = template
+            pages.append(page)
+        batches = parallel.batch_by_template(pages, 2)
+        self.assertEqual(batches, [[0, 2], [3], [1], [4]])
+
+    def build(self, jobs):
+        '''Build a site of a few pages, return the built pages
+        and the HTML files written, by path in the site'''
+        files = {
+            'config.me': 'blocked_dirs = [x]\ndefault_template = default\n',
+            'templates/default.tpl': '{{page.title}}:{{page.content}} '
+                '{% list pages as p: %}{{p.title}} {% end %}!',
+            'templates/other.tpl': '{{page.title}}:{{page.excerpt}}'
+        }
+        for index in range(6):
+            template = 'template = other\n' if index % 2 else ''
+            files['data/p{}/page.me'.format(index)] = (
+                'title = p{0}\ndate = 2020-01-0{1} 00:00:00\n{2}'
+                'content\nbody {0}<!-- more -->end'.format(index, index + 1,
+                                                          template))
+        with tempfile.TemporaryDirectory() as path:
+            for name, content in files.items():
+                os.makedirs(os.path.dirname(os.path.join(path, name)),
+                            exist_ok=True)
+                with open(os.path.join(path, name), 'w') as fp:
+                    fp.write(content)
+            props = reader.parse(files['config.me'])
+            with contextlib.redirect_stdout(io.StringIO()):
+                pages = site.Site(props).generate(path, jobs=jobs)
+            outputs = {}
+            for dirpath, _, filenames in os.walk(os.path.join(path, 'data')):
+                if 'index.html' in filenames:
+                    with open(os.path.join(dirpath, 'index.html')) as fp:
+                        outputs[os.path.relpath(dirpath, path)] = fp.read()
+            paths = [os.path.relpath(page.path, path) for page in pages]
+        return paths, outputs
+
+    def testBuildWithJobs(self):
+        paths, outputs = self.build(jobs=1)
+        self.assertEqual(len(outputs), 6)
+        self.assertEqual(self.build(jobs=2), (paths, outputs))
+
+
+class TestStamperDependencies(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = {
+            'base.tpl': '<{% region "body": %}{% end %}>',
+            'menu.tpl': 'menu',
+            'side.tpl': 'side {{x}}'
+        }
+        for name, content in self.files.items():
+            with open(self.path(name), 'w') as fp:
+                fp.write(content)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def testStaticDependencies(self):
+        text = ('{% use "base.tpl" %}{% region "body": %}'
+                '{% include "menu.tpl" %}{% end %}')
+        stamper = Stamper(text, include_path=self.dir.name)
+        self.assertEqual(stamper.dependencies,
+                         {self.path('base.tpl'), self.path('menu.tpl')})
+        self.assertEqual(stamper.render({}), '<menu>')
+
+    def testDynamicDependencies(self):
+        stamper = Stamper('{% parse name %}{% include other %}!',
+                          include_path=self.dir.name)
+        self.assertEqual(stamper.dependencies, set())
+        rendered = set()
+        stamper.render({'name': 'side.tpl', 'other': 'menu.tpl', 'x': 1,
+                        'render_dependencies': rendered})
+        self.assertEqual(rendered, {self.path('side.tpl'),
+                                    self.path('menu.tpl')})
+        # the parsed tree is shared by the next renders
+        self.assertEqual(stamper.dependencies, set())
+        rendered = set()
+        stamper.render({'name': 'menu.tpl', 'other': 'menu.tpl',
+                        'render_dependencies': rendered})
+        self.assertEqual(rendered, {self.path('menu.tpl')})
+
+    def testIncludesReadOnce(self):
+        includes = IncludeCache()
+        text = '{% include "menu.tpl" %} {% parse "side.tpl" %}!'
+        for compiled in (False, True):
+            for x in range(3):
+                stamper = Stamper(text, self.dir.name, compiled=compiled)
+                rendered = set()
+                context = {'x': x, 'include_cache': includes,
+                           'render_dependencies': rendered}
+                self.assertEqual(stamper.render(context),
+                                 'menu side {}!'.format(x))
+                self.assertEqual(stamper.dependencies,
+                    {self.path('menu.tpl'), self.path('side.tpl')})
+                self.assertEqual(rendered, stamper.dependencies)
+        self.assertEqual((includes.reads, includes.parses), (2, 1))
+
+    def testChangedIncludeIsRead(self):
+        includes = IncludeCache()
+        stamper = Stamper('{% parse "side.tpl" %}!', self.dir.name)
+        stamper.render({'x': 1, 'include_cache': includes})
+        with open(self.path('side.tpl'), 'w') as fp:
+            fp.write('new side {{x}}')
+        includes.refresh()
+        output = stamper.render({'x': 1, 'include_cache': includes})
+        self.assertEqual(output, 'new side 1!')
+        self.assertEqual(includes.parses, 2)
+
+
+class TestTreeCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        with open(self.path('base.tpl'), 'w') as fp:
+            fp.write('<{% region "body": %}{% end %}>')
+        self.cache = TreeCache(self.path('cache'))
+        self.text = '{% use "base.tpl" %}{% region "body": %}{{x}}{% end %}'
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dir.name, name)
+
+    def load(self):
+        return self.cache.load(self.text, self.dir.name, True)
+
+    def testSavedTreeIsLoaded(self):
+        Stamper(self.text, self.dir.name, compiled=True, cache=self.cache)
+        stamper = Stamper(self.text, self.dir.name, compiled=True,
+                          cache=self.cache)
+        self.assertIsNotNone(self.load())
+        self.assertEqual(stamper.render({'x': 1}), '<1>')
+        self.assertEqual(stamper.dependencies, {self.path('base.tpl')})
+
+    def testParserIsNotSaved(self):
+        text = 'a\n{{ missing(1) }}!'
+        Stamper(text, compiled=True, cache=self.cache)
+        stamper = Stamper(text, compiled=True, cache=self.cache)
+        self.assertFalse(hasattr(stamper.parser, 'tokens'))
+        self.assertFalse(hasattr(stamper.parser, 'text'))
+        with self.assertRaisesRegex(Exception, 'line 2, column 4'):
+            stamper.render({})
+
+    def testUnusedEntriesPruned(self):
+        Stamper('old', cache=self.cache)
+        entries = os.listdir(self.path('cache'))
+        past = self.cache.start - 60
+        os.utime(os.path.join(self.path('cache'), entries[0]), (past, past))
+        cache = TreeCache(self.path('cache'))
+        Stamper('new', cache=cache)
+        cache.prune()
+        self.assertEqual(len(os.listdir(self.path('cache'))), 1)
+        self.assertIsNone(cache.load('old'))
+        self.assertIsNotNone(cache.load('new'))
+
+    def testChangedBaseTemplate(self):
+        Stamper(self.text, self.dir.name, compiled=True, cache=self.cache)
+        with open(self.path('base.tpl'), 'w') as fp:
+            fp.write('[{% region "body": %}{% end %}]')
+        self.assertIsNone(self.load())
+        stamper = Stamper(self.text, self.dir.name, compiled=True,
+                          cache=self.cache)
+        self.assertEqual(stamper.render({'x': 1}), '[1]')
+
+
+class TestStamperReentrancy(unittest.TestCase):
+    def setUp(self):
+        self.stamper = Stamper(
+            '{% function twice(x): %}{% return x * 2 %}{% end %}'
+            '{% if n % 2 == 0: %}even{% else: %}odd{% end %} '
+            '{% list items as i: %}{{i.loop.index}}:{{i.v}} {% end %}'
+            '{{twice(n)}}.')
+
+    def context(self, n):
+        return {'n': n, 'items': [{'v': n}, {'v': n + 1}]}
+
+    def testItemsAreNotChanged(self):
+        context = self.context(1)
+        self.assertEqual(self.stamper.render(context), 'odd 0:2 1:1 2.')
+        self.assertEqual(context['items'], [{'v': 1}, {'v': 2}])
+
+    def testValuesInExpressions(self):
+        text = ('{% list tags as t: %}{% if t == "b": %}B{% else: %}{{t}}'
+                '{% end %}{% end %} {% list numbers as i: %}'
+                '{% if i > 1: %}{{i + 1}}{% end %}{% end %}.')
+        context = {'tags': ['a', 'b'], 'numbers': [1, 2, 3]}
+        for compiled in (False, True):
+            stamper = Stamper(text, compiled=compiled)
+            self.assertEqual(stamper.render(context), 'Ba 43.')
+
+    def testConcurrentRenders(self):
+        expected = [self.stamper.render(self.context(n)) for n in range(50)]
+        def render(n):
+            return self.stamper.render(self.context(n))
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            outputs = list(executor.map(render, list(range(50)) * 20))
+        self.assertEqual(outputs, expected * 20)
+
+
+class TestStamperFragments(unittest.TestCase):
+    def setUp(self):
+        self.text = ('{% cache "k" + key: %}{% list items as i: %}'
+                     '{{i.v}}{% end %}{{n}}{% end %}.')
+        self.fragments = FragmentCache()
+
+    def render(self, compiled, key, n):
+        items = PageListing([{'v': 1}, {'v': 2}])
+        context = {'items': items, 'key': key, 'n': n,
+                   'fragment_cache': self.fragments}
+        output = Stamper(self.text, compiled=compiled).render(context)
+        return output, items.usage()
+
+    def testRenderedOnceByKey(self):
+        for compiled in (False, True):
+            self.fragments.start(None)
+            expected = ('211.', [0, 2, True])
+            self.assertEqual(self.render(compiled, 'a', 1), expected)
+            # cached output and listing reads of the first render
+            self.assertEqual(self.render(compiled, 'a', 2), expected)
+            self.assertEqual(self.render(compiled, 'b', 3)[0], '213.')
+            self.assertEqual((self.fragments.hits, self.fragments.misses),
+                             (1, 2))
+
+    def testWithoutCache(self):
+        stamper = Stamper(self.text)
+        output = stamper.render({'items': [], 'key': 'a', 'n': 1})
+        self.assertEqual(output, '1.')
+
+
+class TestStamperStream(unittest.TestCase):
+    def testStreamMatchesRender(self):
+        stamper = Stamper(
+            '{% list items as i: %}{% if i.v == 2: %}{% break %}{% end %}'
+            '[{{i.v}}]{% end %}{% x = 0 %}'
+            '{% while x < 5: %}{% x = x + 1 %}{% if x > 2: %}'
+            '{% break %}{% end %}<{{x}}>{% end %}.')
+        context = {'items': [{'v': v} for v in range(4)]}
+        chunks = []
+        stamper.stream(dict(context), chunks.append)
+        self.assertEqual(''.join(chunks), stamper.render(dict(context)))
+        self.assertEqual(''.join(chunks), '[3]<1><2>.')
+        self.assertGreater(len(chunks), 1)
+
+    def testBreakAndReturn(self):
+        text = ('{% function find(v): %}{% list items as i: %}'
+                '{% if i.v == v: %}{% return i.v * 10 %}{% end %}{% end %}'
+                '{% end %}{% function stop(v): %}<{% if v: %}!{% break %}'
+                '{% end %}>{% end %}{{find(2)}}{% list items as i: %}'
+                '{% stop(i.v == 1) %}{% end %}{% cache "k": %}a'
+                '{% while true: %}b{% break %}{% end %}{% end %}.')
+        context = {'items': [{'v': v} for v in range(4)]}
+        for compiled in (False, True):
+            stamper = Stamper(text, compiled=compiled)
+            chunks = []
+            stamper.stream(dict(context), chunks.append)
+            self.assertEqual(''.join(chunks), '20<><><!ab.')
+            self.assertEqual(stamper.render(dict(context)), '20<><><!ab.')
+
+
+class TestStamperCompiler(unittest.TestCase):
+    def assertSameRender(self, text, context):
+        def render(compiled):
+            try:
+                return Stamper(text, compiled=compiled).render(dict(context))
+            except Exception as error:
+                return str(error)
+        self.assertEqual(render(True), render(False))
+        return render(True)
+
+    def testSameOutput(self):
+        text = ('{% function f(a): %}[{{a}}{% if a > 1: %}{% break %}'
+                '{% end %}]{% end %}{% list items as i: %}{% f(i.v) %}'
+                '{% end %}{% n = 0 %}{% while n < 3: %}{% n = n + 1 %}'
+                '{{n * 2}}{% end %}{{page.title}}{{page.none.x}}')
+        context = {'items': [{'v': v} for v in range(4)],
+                   'page': {'title': 'T'}}
+        self.assertEqual(self.assertSameRender(text, context),
+                         '[3246T')
+
+    def testSameErrors(self):
+        output = self.assertSameRender('a\n{{ 1 + x / 0 }}', {'x': 1})
+        self.assertEqual(output, 'Division by zero at line 2, column 8')
+        output = self.assertSameRender('{% if x: %}{% break %}{% end %}',
+                                       {'x': 1})
+        self.assertEqual(output, 'Invalid break statement at line 1, '
+                         'column 15')
+
+
+class TestStamperLexer(unittest.TestCase):
+    def testTokens(self):
+        tokens = Lexer().tokenize('a {{ {% x.y %} "s" }}{# c #} {% if 1: %}')
+        self.assertEqual([(token.type, token.value, token.column)
+                          for token in tokens],
+                         [('text', 'a ', 0), ('open_var', '{{', 2),
+                          ('identifier', 'x.y', 8), ('string', 's', 15),
+                          ('close_var', '}}', 19), ('text', ' ', 28),
+                          ('keyword', 'if', 32), ('number', '1', 35),
+                          ('symbol', ':', 36)])
+
+    def testUnclosedTag(self):
+        tokens = Lexer().tokenize('{{ a {% b %}')
+        self.assertEqual([(token.type, token.value) for token in tokens],
+                         [('text', '{{ a '), ('identifier', 'b')])
+
+    def testLinePositions(self):
+        lines = LineTable('ab\n\ncd\n')
+        self.assertEqual([lines.position(index) for index in range(6)],
+                         [(1, 1), (1, 2), (1, 3), (2, 1), (3, 1), (3, 2)])
+
+
+class TestStamperLookup(unittest.TestCase):
+    def testDottedNames(self):
+        page = Page()
+        page['title'] = 'T'
+        page['category'] = {'id': 'c'}
+        text = ('{% list pages as p: %}{{p.title}}{{p.category.id}}'
+                '{{p.loop.index}}{{p.none.x}}{% end %}{{site.a.b}}'
+                '{{site.none}}{{page.title.x}}.')
+        context = {'pages': [page], 'site': {'a': {'b': 1}},
+                   'page': page}
+        for compiled in (False, True):
+            output = Stamper(text, compiled=compiled).render(dict(context))
+            self.assertEqual(output, 'Tc01.')
+
+
+class TestScope(unittest.TestCase):
+    def testLayers(self):
+        site = {'a': 1, 'b': 2}
+        scope = Scope(Scope(site, {'b': 3}))
+        scope['c'] = 4
+        self.assertEqual((scope['a'], scope['b'], scope.get('d')),
+                         (1, 3, None))
+        self.assertEqual(dict(scope.items()), {'a': 1, 'b': 3, 'c': 4})
+        self.assertEqual(site, {'a': 1, 'b': 2})
+        copy = scope.copy()
+        copy['c'] = 5
+        self.assertEqual((scope['c'], 'd' in copy), (4, False))
+
+    def testContextIsNotChanged(self):
+        context = {'items': [1, 2]}
+        output = Stamper('{% x = 1 %}{% function f(): %}{{x}}{% end %}'
+                         '{% x = 2 %}{% list items as i: %}{% y = i %}'
+                         '{% end %}{{f()}}{{x}}{{y}}.').render(context)
+        self.assertEqual(output, '12.')
+        self.assertEqual(context, {'items': [1, 2]})
+
+
+class TestStamperOptimizer(unittest.TestCase):
+    def testFoldedTree(self):
+        root = Parser('a{{ 2 * 3 + 1 }}{% if false: %}{{x}}{% end %}'
+                      '{% if 1 < 2: %}b{% else: %}c{% end %}{{x}}.').parse()
+        self.assertEqual([type(node) for node in root.children],
+                         [tree.Text, tree.PrintCommand, tree.Text])
+        self.assertEqual(root.children[0].value, 'a7b')
+        self.assertGreater(root.removed_nodes, 0)
+
+    def testSameOutput(self):
+        text = ('{% n = 2 * 2 %}{% while false: %}x{% end %}'
+                '{% list items as i: %}{% if true: %}[{{i}}]'
+                '{% if i == 2: %}{% break %}{% end %}{% end %}{% end %}'
+                '{{ n + 1 }}{{ not true }}{{ "a" + "b" }}.')
+        context = {'items': [1, 2, 3]}
+        plain = Parser(text, optimize=False).parse()
+        self.assertEqual(plain.removed_nodes, 0)
+        self.assertEqual(Parser(text).parse().render(dict(context)),
+                         plain.render(dict(context)))
+
+    def testErrorsOnRender(self):
+        with self.assertRaises(Exception) as error:
+            Stamper('{% if false: %}x{% end %}{{ 1 / 0 }}.').render({})
+        self.assertEqual(str(error.exception),
+                         'Division by zero at line 1, column 29')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,10 @@
 
 import re
 import os
+import filecmp
+import contextlib
+
+TEMP_SUFFIX = '.tmp'
 
 
 def clear_path(path):
@@ -9,10 +13,11 @@ def clear_path(path):
 
 
 def read_file(path):
-    if not os.path.exists(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except FileNotFoundError:
         raise FileNotFoundError('File {!r} couldn\'t be found!'.format(path))
-    with open(path, 'r') as f:
-        return f.read()
 
 
 def write_file(path, content=''):
@@ -26,6 +31,24 @@ def write_file(path, content=''):
         f.write(content)
 
 
+@contextlib.contextmanager
+def write_stream(path):
+    '''Open a file to write content in parts, replacing the file
+    at path only if the content is new and was fully written'''
+    temp_path = path + TEMP_SUFFIX
+    try:
+        with open(temp_path, 'w') as f:
+            yield f
+        if os.path.exists(path) and filecmp.cmp(temp_path, path, False):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
 def urljoin(*fragments):
     '''Custom URL join function to concatenate and add slashes'''
     url = '/'.join(fragments)
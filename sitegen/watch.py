@@ -0,0 +1,162 @@
+# coding: utf-8
+
+'''
+===============================================================================
+Sitegen
+
+Author: Karlisson M. Bezerra
+E-mail: contact@hacktoon.com
+URL: https://github.com/hacktoon/sitegen
+License: WTFPL - http://sam.zoy.org/wtfpl/COPYING
+===============================================================================
+'''
+
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+# time to wait for more events after a change, editors
+# usually write a file in several steps
+SETTLE_TIME = 0.02
+POLL_INTERVAL = 0.5
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_MODIFY)
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    '''Find changed files by comparing snapshots of a tree'''
+    def __init__(self, root, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+
+    def take_snapshot(self):
+        snapshot = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def changes(self):
+        snapshot = self.take_snapshot()
+        old = self.snapshot
+        self.snapshot = snapshot
+        changed = set(old).symmetric_difference(snapshot)
+        changed.update(path for path, stat in snapshot.items()
+                       if path in old and old[path] != stat)
+        return changed
+
+    def wait(self):
+        '''Block until some files change and return their paths'''
+        while True:
+            time.sleep(self.interval)
+            changed = self.changes()
+            if changed:
+                time.sleep(SETTLE_TIME)
+                return changed | self.changes()
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    '''Find changed files with the Linux inotify API'''
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}
+        try:
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, '{}: {!r}'.format(os.strerror(errno), path))
+        self.dirs[wd] = path
+
+    def add_tree(self, root):
+        for dirpath, _, _ in os.walk(root):
+            self.add_watch(dirpath)
+
+    def read_events(self):
+        changed = set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, report the whole tree
+                changed.add(self.root)
+                continue
+            dirpath = self.dirs.get(wd)
+            if dirpath is None:
+                continue
+            path = os.path.join(dirpath, os.fsdecode(name))
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.add_tree(path)
+                except OSError:
+                    # out of watches, files in it won't be noticed
+                    pass
+        return changed
+
+    def wait(self):
+        '''Block until some files change and return their paths'''
+        changed = set()
+        while not changed:
+            select.select([self.fd], [], [])
+            changed = self.read_events()
+        while select.select([self.fd], [], [], SETTLE_TIME)[0]:
+            changed.update(self.read_events())
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_watcher(root, interval=POLL_INTERVAL, polling=False):
+    '''Return an inotify watcher if possible, or a polling one'''
+    if sys.platform.startswith('linux') and not polling:
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError):
+            # no inotify or too many directories to watch
+            pass
+    return PollingWatcher(root, interval)